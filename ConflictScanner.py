@@ -0,0 +1,130 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import io
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+
+class ConflictScanner:
+    START_MARKER = b"<<<<<<<"
+    END_MARKER = b">>>>>>>"
+    # same heuristic as git. a file which has NUL in the first 8000 bytes is binary.
+    BINARY_CHECK_SIZE = 8000
+    # the process pool is used only if there are enough files to amortize the startup
+    PARALLEL_THRESHOLD = 64
+    CHUNK_SIZE = 32
+
+    def __init__(self, margin_line_count=10, workers=None):
+        self.margin_line_count = margin_line_count
+        self.workers = workers if workers else os.cpu_count()
+
+    @staticmethod
+    def _find_markers(mm, marker):
+        # the offsets of the marker at the beginning of the line
+        result = []
+        if mm[:len(marker)] == marker:
+            result.append(0)
+        pattern = b"\n" + marker
+        pos = mm.find(pattern)
+        while pos != -1:
+            result.append(pos + 1)
+            pos = mm.find(pattern, pos + 1)
+        return result
+
+    @staticmethod
+    def _get_line_start(mm, offset, line_count):
+        # go back line_count lines from the line start
+        for _ in range(line_count):
+            if offset == 0:
+                break
+            offset = mm.rfind(b"\n", 0, offset - 1) + 1
+        return offset
+
+    @staticmethod
+    def _get_line_end(mm, offset, line_count):
+        # the end of the line and line_count lines after it
+        for _ in range(line_count + 1):
+            pos = mm.find(b"\n", offset)
+            if pos == -1:
+                return len(mm)
+            offset = pos + 1
+        return offset
+
+    @staticmethod
+    def _get_windows(mm, margin_line_count):
+        # [(start offset, end offset, start line)] around <<<<<<< ~ >>>>>>> with the margin
+        markers = sorted([(offset, True) for offset in ConflictScanner._find_markers(mm, ConflictScanner.START_MARKER)] + [(offset, False) for offset in ConflictScanner._find_markers(mm, ConflictScanner.END_MARKER)])
+        windows = []
+        line = 0
+        last_offset = 0
+        start = None
+        for offset, is_start in markers:
+            # count the new lines incrementally. the markers are sorted.
+            line += mm[last_offset:offset].count(b"\n")
+            last_offset = offset
+            if is_start:
+                if start == None:
+                    start = (offset, line)
+            elif start != None:
+                start_offset, start_line = start
+                window_start = ConflictScanner._get_line_start(mm, start_offset, margin_line_count)
+                window_start_line = start_line - mm[window_start:start_offset].count(b"\n")
+                window_end = ConflictScanner._get_line_end(mm, offset, margin_line_count)
+                if windows and window_start <= windows[-1][1]:
+                    windows[-1][1] = window_end
+                else:
+                    windows.append([window_start, window_end, window_start_line])
+                start = None
+        return windows
+
+    @staticmethod
+    def scan_file(file_path, margin_line_count=10):
+        # return (file_path, [(start line, lines)], is_utf8) or None if the file doesn't have the conflict
+        try:
+            with open(file_path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if mm.find(b"\0", 0, ConflictScanner.BINARY_CHECK_SIZE) != -1 or mm.find(ConflictScanner.START_MARKER) == -1:
+                        return None
+                    # decode only around the markers
+                    is_utf8 = True
+                    result = []
+                    for start, end, start_line in ConflictScanner._get_windows(mm, margin_line_count):
+                        data = mm[start:end]
+                        try:
+                            text = data.decode("utf-8")
+                        except UnicodeDecodeError:
+                            is_utf8 = False
+                            text = data.decode("utf-8", errors="replace")
+                        # same as readlines of the text mode. \r\n is \n.
+                        result.append((start_line, io.StringIO(text, newline=None).readlines()))
+        except (OSError, ValueError):
+            return None
+        return (file_path, result, is_utf8) if result else None
+
+    def scan(self, file_paths):
+        # yield (file_path, [(start line, lines)], is_utf8) of the files which have the conflict
+        file_paths = list(file_paths)
+        margin_line_counts = [self.margin_line_count] * len(file_paths)
+        if self.workers > 1 and len(file_paths) >= ConflictScanner.PARALLEL_THRESHOLD:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                for result in executor.map(ConflictScanner.scan_file, file_paths, margin_line_counts, chunksize=ConflictScanner.CHUNK_SIZE):
+                    if result:
+                        yield result
+        else:
+            for result in map(ConflictScanner.scan_file, file_paths, margin_line_counts):
+                if result:
+                    yield result
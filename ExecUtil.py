@@ -14,6 +14,147 @@
 
 import subprocess
 import os
+import sys
+import time
+import shlex
+import signal
+import threading
+from collections import deque
+
+class ExecResult:
+    def __init__(self, argv, cwd, returncode, stdout, stderr, elapsed, timed_out=False, cancelled=False):
+        self.argv = argv
+        self.cwd = cwd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out and not self.cancelled
+
+    def get_lines(self, enableStrip=True):
+        lines = self.stdout.splitlines()
+        return [line.strip() for line in lines] if enableStrip else lines
+
+    def __repr__(self):
+        return f'{shlex.join(self.argv)}: exit={self.returncode} elapsed={self.elapsed:.2f}s{" timeout" if self.timed_out else ""}{" cancelled" if self.cancelled else ""}'
+
+
+class ExecRunner:
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, timeout=None, verbose=False, history=100):
+        self.timeout = timeout
+        self.verbose = verbose
+        # the recent results for debugging
+        self.results = deque(maxlen=history)
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._procs = set()
+
+    def cancel(self):
+        self._cancelled.set()
+        with self._lock:
+            procs = list(self._procs)
+        for proc in procs:
+            ExecRunner._kill(proc)
+
+    def reset(self):
+        self._cancelled.clear()
+
+    @staticmethod
+    def _kill(proc):
+        try:
+            if getattr(proc, "own_process_group", False):
+                # kill the children (e.g. ssh of git) together
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _get_process_group_options(timeout):
+        # the own process group is needed to kill the children on timeout.
+        # without timeout, stay in the foreground group to keep the ssh prompts (host key, passphrase) working.
+        if not timeout:
+            return {}
+        if sys.version_info >= (3, 11):
+            return {"process_group": 0}
+        return {"preexec_fn": os.setpgrp}
+
+    def run(self, argv, cwd=".", timeout=None, verbose=None, input=None, env=None):
+        # input: text to write to stdin. env: variables added to the current environment.
+        timeout = timeout if timeout != None else self.timeout
+        verbose = verbose if verbose != None else self.verbose
+        start_time = time.monotonic()
+        stdout = ""
+        stderr = ""
+        returncode = None
+        timed_out = False
+        cancelled = self._cancelled.is_set()
+
+        if not cancelled:
+            process_group_options = ExecRunner._get_process_group_options(timeout)
+            try:
+                proc = subprocess.Popen(argv, cwd=cwd, stdin=subprocess.PIPE if input != None else subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=dict(os.environ, **env) if env else None, **process_group_options)
+            except OSError as e:
+                proc = None
+                stderr = str(e)
+            if proc:
+                proc.own_process_group = bool(process_group_options)
+                with self._lock:
+                    self._procs.add(proc)
+                _input = input.encode("utf-8") if input != None else None
+                try:
+                    while True:
+                        try:
+                            # the input is written only once even if communicate is called again
+                            _stdout, _stderr = proc.communicate(input=_input, timeout=ExecRunner.POLL_INTERVAL)
+                            break
+                        except subprocess.TimeoutExpired:
+                            if self._cancelled.is_set():
+                                cancelled = True
+                            elif timeout and time.monotonic() - start_time > timeout:
+                                timed_out = True
+                            if cancelled or timed_out:
+                                ExecRunner._kill(proc)
+                                _stdout, _stderr = proc.communicate()
+                                break
+                finally:
+                    with self._lock:
+                        self._procs.discard(proc)
+                stdout = _stdout.decode("utf-8", errors="replace")
+                stderr = _stderr.decode("utf-8", errors="replace")
+                returncode = proc.returncode
+
+        result = ExecResult(argv, cwd, returncode, stdout, stderr, time.monotonic() - start_time, timed_out, cancelled)
+        self.results.append(result)
+        if verbose:
+            sys.stdout.write(stdout)
+            sys.stderr.write(stderr)
+            if not result.ok:
+                print(f'Failed: {result}')
+        return result
+
+    def run_script(self, script, cwd="."):
+        # run "cmd1; cd dir; cmd2" without shell. return the last directory.
+        current_dir = cwd
+        for command in script.split(';'):
+            command = command.strip()
+            if command.startswith('cd '):
+                current_dir = os.path.join(current_dir, command[3:].strip())
+                if not os.path.isdir(current_dir):
+                    # same as cd of shell with &&. e.g. the clone failed.
+                    break
+            elif command:
+                self.run(shlex.split(command), current_dir)
+        return current_dir
+
 
 class ExecUtil:
     @staticmethod
@@ -0,0 +1,172 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import sys
+import json
+from datetime import datetime
+
+class JsonlWriter:
+    def __init__(self, path):
+        self.is_stdout = not path or path == "-"
+        self.file = sys.stdout if self.is_stdout else open(path, 'w', encoding='utf-8')
+
+    def write(self, row):
+        self.file.write(json.dumps(row, ensure_ascii=False, default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value)))
+        self.file.write("\n")
+
+    def close(self):
+        if self.is_stdout:
+            self.file.flush()
+        else:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ArrowWriter:
+    BATCH_SIZE = 1000
+
+    def __init__(self, path, schema, format="parquet"):
+        import pyarrow
+        self.pa = pyarrow
+        self.path = path
+        self.format = format
+        self.schema = pyarrow.schema([(name, ArrowWriter._get_type(pyarrow, type_name)) for name, type_name in schema])
+        self.rows = []
+        if format == "parquet":
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    @staticmethod
+    def _get_type(pyarrow, type_name):
+        if type_name == "int":
+            return pyarrow.int64()
+        elif type_name == "timestamp":
+            return pyarrow.timestamp("s")
+        return pyarrow.string()
+
+    def _flush(self):
+        if self.rows:
+            # write per record batch to keep the memory flat
+            self.writer.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= ArrowWriter.BATCH_SIZE:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ExportUtil:
+    OUTPUT_FORMATS = ["text", "jsonl", "parquet", "arrow"]
+    # the columnar formats can't be written to stdout
+    COLUMNAR_FORMATS = ["parquet", "arrow"]
+
+    CHANGE_SCHEMA = [
+        ("project", "str"),
+        ("branch", "str"),
+        ("number", "int"),
+        ("change_id", "str"),
+        ("subject", "str"),
+        ("status", "str"),
+        ("url", "str"),
+        ("created", "timestamp"),
+        ("last_updated", "timestamp"),
+        ("project_dir", "str"),
+        ("patchset1_ssh", "str"),
+        ("patchset1_repo", "str"),
+        ("current_patchset_ssh", "str"),
+        ("comment_count", "int"),
+    ]
+
+    COMMENT_SCHEMA = [
+        ("project", "str"),
+        ("branch", "str"),
+        ("number", "int"),
+        ("change_id", "str"),
+        ("status", "str"),
+        ("created", "timestamp"),
+        ("last_updated", "timestamp"),
+        ("file", "str"),
+        ("line", "int"),
+        ("reviewer", "str"),
+        ("reviewer_email", "str"),
+        ("message", "str"),
+    ]
+
+    @staticmethod
+    def new_writer(output, path, schema):
+        if output in ExportUtil.COLUMNAR_FORMATS:
+            if not path or path == "-":
+                raise ValueError(f'output file is required for {output}')
+            return ArrowWriter(path, schema, output)
+        return JsonlWriter(path)
+
+    @staticmethod
+    def change_to_row(project, branch, theData):
+        return {
+            "project": project,
+            "branch": branch,
+            "number": int(theData["number"]),
+            "change_id": theData["Change-Id"],
+            "subject": theData["subject"],
+            "status": theData["status"],
+            "url": theData["url"],
+            "created": theData["Created"],
+            "last_updated": theData["Last Updated"],
+            "project_dir": theData["project_dir"],
+            "patchset1_ssh": theData["patchset1_ssh"],
+            "patchset1_repo": theData["patchset1_repo"],
+            "current_patchset_ssh": theData.get("current_patchset_ssh"),
+            "comment_count": sum(len(comments) for lines in theData["comments"].values() for comments in lines.values()),
+        }
+
+    @staticmethod
+    def iter_comment_rows(project, branch, theData):
+        # flatten comments[file][line]
+        for filename, lines in theData["comments"].items():
+            for line, comments in lines.items():
+                for comment in comments:
+                    reviewer = comment["reviewer"] if isinstance(comment["reviewer"], dict) else {"name": str(comment["reviewer"])}
+                    yield {
+                        "project": project,
+                        "branch": branch,
+                        "number": int(theData["number"]),
+                        "change_id": theData["Change-Id"],
+                        "status": theData["status"],
+                        "created": theData["Created"],
+                        "last_updated": theData["Last Updated"],
+                        "file": filename,
+                        "line": int(line),
+                        "reviewer": reviewer.get("name", reviewer.get("username")),
+                        "reviewer_email": reviewer.get("email"),
+                        "message": comment["message"],
+                    }
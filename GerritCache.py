@@ -0,0 +1,125 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+import json
+import sqlite3
+from datetime import datetime, timezone
+from GerritUtil import GerritUtil
+
+class GerritCache:
+    DATE_KEYS = ["Created", "Last Updated"]
+    ALL_STATUS = "open|merged|abandoned"
+    STATUS_MAPPER = {
+        "open": ["NEW"],
+        "new": ["NEW"],
+        "merged": ["MERGED"],
+        "abandoned": ["ABANDONED"],
+        "closed": ["MERGED", "ABANDONED"],
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS changes (number TEXT, kind TEXT, project TEXT, branch TEXT, status TEXT, last_updated REAL, data TEXT, PRIMARY KEY (number, kind))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS changes_branch ON changes (kind, branch, last_updated)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS sync (sync_key TEXT PRIMARY KEY, covered_since REAL, high_water_mark REAL)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def _get_kind(connection, extra_commands):
+        # records queried with --comments etc. have more data than the others
+        return " ".join([connection] + sorted(extra_commands))
+
+    @staticmethod
+    def _encode(theData):
+        if not isinstance(theData, dict):
+            theData = theData.to_dict()
+        return json.dumps(theData, default=lambda value: value.isoformat() if isinstance(value, datetime) else str(value))
+
+    @staticmethod
+    def _decode(data):
+        theData = json.loads(data)
+        for key in GerritCache.DATE_KEYS:
+            if key in theData:
+                theData[key] = datetime.fromisoformat(theData[key])
+        if "comments" in theData:
+            # json converts the line number key to str
+            for filename, comments in theData["comments"].items():
+                theData["comments"][filename] = {int(line) if str(line).isdigit() else line: _comments for line, _comments in comments.items()}
+        return theData
+
+    def store(self, kind, project, branch, theData):
+        last_updated = theData["Last Updated"].timestamp()
+        self.db.execute(
+            "INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(number, kind) DO UPDATE SET project=excluded.project, branch=excluded.branch, status=excluded.status, last_updated=excluded.last_updated, data=excluded.data WHERE excluded.last_updated >= changes.last_updated",
+            (theData["number"], kind, project, branch, theData["status"], last_updated, GerritCache._encode(theData))
+        )
+
+    def get_sync_state(self, sync_key):
+        row = self.db.execute("SELECT covered_since, high_water_mark FROM sync WHERE sync_key=?", (sync_key,)).fetchone()
+        return (row[0], row[1]) if row else (None, None)
+
+    def set_sync_state(self, sync_key, covered_since, high_water_mark):
+        self.db.execute("INSERT OR REPLACE INTO sync VALUES (?, ?, ?)", (sync_key, covered_since, high_water_mark))
+
+    def sync(self, ssh_target_host, branch, since, numbers, extra_commands=[], connection="http"):
+        kind = GerritCache._get_kind(connection, extra_commands)
+        numbers = [number for number in numbers if number]
+        if numbers:
+            for project, _branch, theData in GerritUtil.iter_query(ssh_target_host, branch, GerritCache.ALL_STATUS, since, numbers, extra_commands, connection):
+                self.store(kind, project, _branch, theData)
+        else:
+            sync_key = f'{ssh_target_host} {branch} {kind}'
+            since_timestamp = GerritUtil.parse_since_date(since).timestamp()
+            covered_since, high_water_mark = self.get_sync_state(sync_key)
+            if covered_since == None or since_timestamp < covered_since:
+                # the cache doesn't cover the period yet
+                covered_since = since_timestamp
+                high_water_mark = None
+            if high_water_mark:
+                # ask only changes updated after the previous sync. status is not specified to catch the status changes.
+                since = datetime.fromtimestamp(high_water_mark, timezone.utc).strftime("%Y-%m-%d %H:%M:%S +0000")
+            for project, _branch, theData in GerritUtil.iter_query(ssh_target_host, branch, GerritCache.ALL_STATUS, since, [], extra_commands, connection):
+                self.store(kind, project, _branch, theData)
+                high_water_mark = max(high_water_mark or 0, theData["Last Updated"].timestamp())
+            self.set_sync_state(sync_key, covered_since, high_water_mark or covered_since)
+        self.db.commit()
+
+    def iter_query(self, branch, status, since, numbers, extra_commands=[], connection="http", filter_git=None):
+        kind = GerritCache._get_kind(connection, extra_commands)
+        numbers = [number for number in numbers if number]
+        if filter_git:
+            filter_git = re.compile(filter_git)
+
+        if numbers:
+            cursor = self.db.execute(f'SELECT project, branch, data FROM changes WHERE kind=? AND number IN ({",".join("?"*len(numbers))}) ORDER BY last_updated DESC', [kind] + numbers)
+        else:
+            statuses = []
+            for _status in status.split("|"):
+                statuses.extend(GerritCache.STATUS_MAPPER.get(_status.lower(), [_status.upper()]))
+            since_timestamp = GerritUtil.parse_since_date(since).timestamp()
+            cursor = self.db.execute(f'SELECT project, branch, data FROM changes WHERE kind=? AND branch=? AND status IN ({",".join("?"*len(statuses))}) AND last_updated >= ? ORDER BY last_updated DESC', [kind, branch] + statuses + [since_timestamp])
+
+        for project, _branch, data in cursor:
+            if not filter_git or filter_git.match(project):
+                yield project, _branch, GerritCache._decode(data)
+
+    def query(self, ssh_target_host, branch, status, since, numbers, extra_commands=[], connection="http", filter_git=None, offline=False):
+        if not offline:
+            self.sync(ssh_target_host, branch, since, numbers, extra_commands, connection)
+        return GerritUtil.group_results(self.iter_query(branch, status, since, numbers, extra_commands, connection, filter_git))
@@ -0,0 +1,305 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import re
+import threading
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from GerritUtil import GerritUtil
+from WorkspaceCache import WorkspaceCache
+from RepoUtil import RepoUtil
+
+def _iter_prefetch(downloader, results):
+    # read the results in background and prefetch each change as it arrives.
+    # yield (project, branch, theData) in the query order while the query continues.
+    queue = Queue()
+    stopped = threading.Event()
+    def _feed():
+        try:
+            for result in results:
+                if stopped.is_set():
+                    break
+                downloader.prefetch([result])
+                queue.put(result)
+            queue.put(None)
+        except Exception as e:
+            queue.put(e)
+    threading.Thread(target=_feed, daemon=True).start()
+    try:
+        while True:
+            result = queue.get()
+            if result == None:
+                break
+            if isinstance(result, Exception):
+                raise result
+            yield result
+    finally:
+        stopped.set()
+
+
+class GerritDownloader:
+    DEFAULT_WORKERS = 4
+    DEFAULT_HOST_WORKERS = 2
+    # how many downloads can be ahead of get() in addition to the workers
+    PREFETCH_WINDOW = 2
+    HOST_PATTERN = re.compile(r'[a-z+]+://(?:[^@/]+@)?([^/:]+)')
+
+    def __init__(self, base_dir, download_key="patchset1_ssh", force_renew=False, mirror_dir=None, sparse=False, depth=0, workers=DEFAULT_WORKERS, host_workers=DEFAULT_HOST_WORKERS, quota=None):
+        self.base_dir = base_dir
+        self.download_key = download_key
+        self.force_renew = force_renew
+        self.mirror_dir = mirror_dir
+        self.sparse = sparse
+        self.depth = depth
+        self.workers = max(1, workers)
+        self.host_workers = max(1, host_workers)
+        self.executor = None
+        self.futures = {}
+        # the prefetched workspaces are locked until get(). limit them not to exceed the quota.
+        self.max_prefetch = self.workers + GerritDownloader.PREFETCH_WINDOW
+        self.queued = []
+        self.queued_numbers = set()
+        self.host_semaphores = {}
+        self.lock = threading.Lock()
+        self.total = 0
+        self.done = 0
+        # the workspace is locked from the download until the next change is requested
+        self.workspace_cache = WorkspaceCache(base_dir, quota) if quota else None
+        self.workspace_locks = {}
+        self.workspace_in_use = None
+
+    @staticmethod
+    def new_downloader(args, download_key="patchset1_ssh"):
+        if args.repo:
+            return RepoDownloader(args.repo, download_key, args.workers)
+        return GerritDownloader(args.download, download_key, args.renew, args.mirror, args.sparse, args.depth, args.workers, args.hostworkers, args.quota)
+
+    def _get_host_semaphore(self, download_cmd):
+        m = GerritDownloader.HOST_PATTERN.search(download_cmd)
+        host = m.group(1) if m else None
+        with self.lock:
+            if not host in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.host_workers)
+            return self.host_semaphores[host]
+
+    def _download(self, theData):
+        number = theData["number"]
+        download_cmd = theData[self.download_key]
+        sparse_files = GerritUtil.get_sparse_files(theData) if self.sparse else None
+        workspace_lock = self.workspace_cache.acquire(number) if self.workspace_cache else None
+        try:
+            with self._get_host_semaphore(download_cmd):
+                result = GerritUtil.download(self.base_dir, number, download_cmd, self.force_renew, self.mirror_dir, sparse_files, self.depth)
+            if self.workspace_cache:
+                self.workspace_cache.update(number)
+                self.workspace_cache.evict()
+        except:
+            if self.workspace_cache:
+                self.workspace_cache.release(workspace_lock)
+            raise
+        with self.lock:
+            self.workspace_locks[number] = workspace_lock
+        return result
+
+    def _release_workspace(self):
+        if self.workspace_cache and self.workspace_in_use:
+            number, workspace_lock = self.workspace_in_use
+            # the last use is when the processing is done
+            self.workspace_cache.touch(number)
+            self.workspace_cache.release(workspace_lock)
+            self.workspace_cache.evict()
+        self.workspace_in_use = None
+
+    def _on_done(self, number, future):
+        with self.lock:
+            self.done += 1
+            error = future.exception()
+            status = f'failed ({error})' if error else 'done'
+            print(f'[download {self.done}/{self.total}] {number}: {status}')
+
+    def _submit_queued(self):
+        submitted = []
+        with self.lock:
+            while self.queued and len(self.futures) < self.max_prefetch:
+                theData = self.queued.pop(0)
+                number = theData["number"]
+                self.queued_numbers.discard(number)
+                if not self.executor:
+                    self.executor = ThreadPoolExecutor(max_workers=self.workers)
+                future = self.executor.submit(self._download, theData)
+                self.futures[number] = future
+                submitted.append((number, future))
+        for number, future in submitted:
+            future.add_done_callback(lambda _future, number=number: self._on_done(number, _future))
+
+    def prefetch(self, results):
+        # results: (project, branch, theData) in the query order
+        for project, branch, theData in results:
+            number = theData["number"]
+            with self.lock:
+                if not theData.get(self.download_key) or number in self.futures or number in self.queued_numbers:
+                    continue
+                self.total += 1
+                self.queued.append(theData)
+                self.queued_numbers.add(number)
+        self._submit_queued()
+
+    def iter_prefetch(self, results):
+        # same as prefetch but start the downloads before the query finishes
+        return _iter_prefetch(self, results)
+
+    def get(self, theData):
+        # return the download path or None if the download failed
+        number = theData["number"]
+        # the previous change is done
+        self._release_workspace()
+        with self.lock:
+            future = self.futures.pop(number, None)
+            if number in self.queued_numbers:
+                # requested before its turn. download it now.
+                self.queued = [queued for queued in self.queued if queued["number"] != number]
+                self.queued_numbers.discard(number)
+                self.total -= 1
+        # the next one can be prefetched
+        self._submit_queued()
+        result = None
+        try:
+            if future:
+                result = future.result()
+            elif theData.get(self.download_key):
+                result = self._download(theData)
+        except Exception as e:
+            print(f'Failed to download {number}: {e}')
+        with self.lock:
+            if number in self.workspace_locks:
+                self.workspace_in_use = (number, self.workspace_locks.pop(number))
+        return result
+
+    def download_all(self, results):
+        # yield (project, branch, theData, download_path) in the query order
+        for project, branch, theData in self.iter_prefetch(results):
+            yield project, branch, theData, self.get(theData)
+
+    def close(self):
+        with self.lock:
+            executor = self.executor
+            self.executor = None
+            for future in self.futures.values():
+                future.cancel()
+            self.futures = {}
+            self.queued = []
+            self.queued_numbers = set()
+        if executor:
+            executor.shutdown(wait=True)
+        self._release_workspace()
+        if self.workspace_cache:
+            for workspace_lock in self.workspace_locks.values():
+                self.workspace_cache.release(workspace_lock)
+        self.workspace_locks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RepoDownloader:
+    # download the changes into the existing repo workspace. one change at a time per project.
+    def __init__(self, repo_dir, download_key="patchset1_ssh", workers=GerritDownloader.DEFAULT_WORKERS):
+        self.repo_dir = repo_dir
+        self.download_key = download_key
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.project_paths = RepoUtil.get_project_paths(repo_dir)
+        self.pending = {}
+        self.futures = {}
+        self.busy_projects = set()
+        self.project_in_use = None
+        self.lock = threading.Lock()
+
+    def _get_change(self, theData):
+        project, number, _ = RepoUtil.parse_repo_download_cmd(theData["patchset1_repo"])
+        return project, number, RepoUtil.get_patchset(theData.get(self.download_key))
+
+    def _download(self, project, number, patchset):
+        if not project in self.project_paths:
+            raise ValueError(f'{project} is not in the repo workspace')
+        result = RepoUtil.download(self.repo_dir, self.project_paths[project], project, number, patchset)
+        print(f'[repo download] {project} {number}/{patchset}: done')
+        return result
+
+    def _schedule(self):
+        # the next change of the project can be downloaded after the previous one is processed
+        with self.lock:
+            for project, changes in self.pending.items():
+                if changes and not project in self.busy_projects:
+                    number, patchset = changes.pop(0)
+                    self.busy_projects.add(project)
+                    self.futures[number] = self.executor.submit(self._download, project, number, patchset)
+
+    def prefetch(self, results):
+        for project, branch, theData in results:
+            project, number, patchset = self._get_change(theData)
+            with self.lock:
+                if project and not number in self.futures:
+                    self.pending.setdefault(project, []).append((number, patchset))
+        self._schedule()
+
+    def iter_prefetch(self, results):
+        return _iter_prefetch(self, results)
+
+    def _release_project(self):
+        if self.project_in_use:
+            with self.lock:
+                self.busy_projects.discard(self.project_in_use)
+            self.project_in_use = None
+            self._schedule()
+
+    def get(self, theData):
+        # return the project directory or None if the download failed
+        self._release_project()
+        project, number, patchset = self._get_change(theData)
+        result = None
+        with self.lock:
+            future = self.futures.pop(number, None)
+            if not future and project:
+                # not prefetched e.g. the event daemon
+                self.busy_projects.add(project)
+        try:
+            if future:
+                result = future.result()
+            elif project:
+                result = self._download(project, number, patchset)
+        except Exception as e:
+            print(f'Failed to download {number}: {e}')
+        self.project_in_use = project
+        return result
+
+    def download_all(self, results):
+        for project, branch, theData in self.iter_prefetch(results):
+            yield project, branch, theData, self.get(theData)
+
+    def close(self):
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.pending = {}
+        self.executor.shutdown(wait=True)
+        self.futures = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,100 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import requests
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+class GerritRestClient:
+    XSSI_PREFIX = ")]}'"
+    TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+    # extra_commands of ssh gerrit query -> REST query option
+    SSH_OPTION_MAPPER = {
+        "--current-patch-set": "CURRENT_REVISION",
+        "--patch-sets": "ALL_REVISIONS",
+        "--all-approvals": "DETAILED_LABELS",
+        "--files": "CURRENT_FILES",
+        "--comments": "MESSAGES",
+    }
+
+    _clients = {}
+
+    def __init__(self, base_url, user=None, password=None, pool_size=8, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.prefix = ""
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers['accept'] = 'application/json'
+        if user and password:
+            # authenticated REST endpoints are under /a/
+            self.session.auth = (user, password)
+            self.prefix = "/a"
+
+    @staticmethod
+    def get_client(base_url, user=None, password=None):
+        # share the keep-alive connection pool among queries in the same process
+        key = (base_url, user)
+        if not key in GerritRestClient._clients:
+            GerritRestClient._clients[key] = GerritRestClient(base_url, user, password)
+        return GerritRestClient._clients[key]
+
+    @staticmethod
+    def parse_timestamp(timestamp):
+        # Gerrit REST timestamp is UTC with nano seconds e.g. 2024-01-01 12:34:56.000000000
+        date = datetime.strptime(timestamp[0:19], GerritRestClient.TIMESTAMP_FORMAT)
+        return date.replace(tzinfo=timezone.utc).timestamp()
+
+    def get(self, path, params=None):
+        response = self.session.get(f'{self.base_url}{self.prefix}{path}', params=params, timeout=self.timeout)
+        response.raise_for_status()
+        text = response.text
+        if text.startswith(GerritRestClient.XSSI_PREFIX):
+            text = text[len(GerritRestClient.XSSI_PREFIX):]
+        return json_loads(text)
+
+    def post(self, path, body):
+        response = self.session.post(f'{self.base_url}{self.prefix}{path}', json=body, timeout=self.timeout)
+        response.raise_for_status()
+        text = response.text
+        if text.startswith(GerritRestClient.XSSI_PREFIX):
+            text = text[len(GerritRestClient.XSSI_PREFIX):]
+        return json_loads(text) if text.strip() else None
+
+    def query_changes(self, query, options=[], start=0, limit=None):
+        params = [("q", query)]
+        for option in options:
+            params.append(("o", option))
+        if start:
+            params.append(("S", str(start)))
+        if limit:
+            params.append(("n", str(limit)))
+        return self.get("/changes/", params)
+
+    def get_comments(self, number):
+        return self.get(f'/changes/{quote(str(number), safe="")}/revisions/current/comments')
+
+    def set_review(self, number, revision, review):
+        return self.post(f'/changes/{quote(str(number), safe="")}/revisions/{quote(str(revision), safe="")}/review', review)
@@ -0,0 +1,108 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+from GerritUtil import GerritUtil
+
+class GerritUploader:
+    DEFAULT_BATCH_SIZE = 20
+    UPLOAD_REF_PREFIX = "refs/gerrit-util/upload/"
+
+    def __init__(self, ssh_target_host, connection="http", labels=[], message=None, batch_size=DEFAULT_BATCH_SIZE, workspace_cache=None):
+        self.ssh_target_host = ssh_target_host
+        self.connection = connection
+        self.labels = labels
+        self.message = message
+        self.batch_size = batch_size
+        # keep the pending workspaces from the eviction until they are pushed
+        self.workspace_cache = workspace_cache
+        self.pending = []
+        # called with the uploaded [(number, sha)] after each push e.g. to ignore own patchset-created events
+        self.on_uploaded = None
+
+    @staticmethod
+    def new_uploader(args, downloader=None):
+        return GerritUploader(args.target, args.connection, args.label, args.message, args.uploadbatch, getattr(downloader, "workspace_cache", None))
+
+    def add(self, target_folder, branch, number, files=None):
+        # commit now and push later. the labels and the message are posted together. files: the modified files
+        if not os.path.exists(os.path.join(target_folder, ".git")):
+            return False
+        sha = GerritUtil.commit_amend(target_folder, files)
+        if not sha:
+            return False
+        # the ref keeps the commit even if the workspace is reused for the next change e.g. repo workspace
+        upload_ref = f'{GerritUploader.UPLOAD_REF_PREFIX}{number}'
+        GerritUtil.runner.run(["git", "update-ref", upload_ref, sha], target_folder, verbose=False)
+        self.pending.append({
+            "target_folder": target_folder,
+            "branch": branch,
+            "number": str(number),
+            "sha": sha,
+            "upload_ref": upload_ref,
+            "remote": GerritUtil.get_push_remote(target_folder),
+            "workspace_lock": self.workspace_cache.acquire(number) if self.workspace_cache else None,
+        })
+        if self.batch_size and len(self.pending) >= self.batch_size:
+            self.flush()
+        return True
+
+    @staticmethod
+    def _push(item):
+        # gerrit accepts only one refs/for/* command per push. the ssh connection is shared with --sshmux.
+        refspec = f'{item["sha"]}:refs/for/{item["branch"]}'
+        with GerritUtil.session():
+            result = GerritUtil.runner.run(["git", "push", "--porcelain", item["remote"], refspec], item["target_folder"])
+        # e.g. *\tsha:refs/for/main\t[new reference]
+        for line in result.get_lines(False):
+            fields = line.split("\t")
+            if len(fields) >= 2 and fields[1] == refspec:
+                if fields[0] != "!":
+                    return True
+                print(f'Failed to upload {item["number"]}: {fields[2] if len(fields) > 2 else ""}')
+                return False
+        if not result.ok:
+            print(f'Failed to upload {item["number"]}')
+        return result.ok
+
+    def flush(self):
+        # return the uploaded (number, sha)
+        uploaded = []
+        try:
+            for item in self.pending:
+                if GerritUploader._push(item):
+                    uploaded.append(item)
+        finally:
+            for item in self.pending:
+                GerritUtil.runner.run(["git", "update-ref", "-d", item["upload_ref"]], item["target_folder"], verbose=False)
+                if self.workspace_cache:
+                    self.workspace_cache.release(item["workspace_lock"])
+            self.pending = []
+
+        changes = [(item["number"], item["sha"]) for item in uploaded]
+        if changes and self.on_uploaded:
+            self.on_uploaded(changes)
+        if changes and (self.labels or self.message):
+            # the uploaded commit is the new patchset. one gerrit review for all the changes.
+            GerritUtil.review(self.ssh_target_host, changes, self.labels, self.message, self.connection)
+        return changes
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -14,15 +14,166 @@
 
 import os
 import re
+import shlex
 import subprocess
 import json
 import shutil
+import fcntl
 from datetime import datetime, timedelta
-from ExecUtil import ExecUtil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from ExecUtil import ExecRunner
+from SshUtil import SshUtil
+from RateGovernor import RateGovernor
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+class ChangeRecord:
+    HTTP_URL_PATTERN = re.compile(r'http://[^/]+/')
+
+    __slots__ = ("number", "change_id", "subject", "status", "url", "created_on", "project", "project_dir", "branch", "last_updated_on", "base_url", "current_patch_set_ref", "files", "comments", "ssh_target_host", "connection", "_patchset1_ssh", "_current_patchset_ssh")
+
+    def __init__(self, base_url, project, branch, number, change_id, subject, status, url, created_on, last_updated_on, current_patch_set_ref=None, files=None):
+        self.base_url = base_url
+        self.project = project
+        self.branch = branch
+        self.number = number
+        self.change_id = change_id
+        self.subject = subject
+        self.status = status
+        self.url = url
+        self.created_on = created_on
+        self.last_updated_on = last_updated_on
+        self.current_patch_set_ref = current_patch_set_ref
+        self.files = files
+        self.project_dir = project[project.rfind("/")+1:]
+        self.comments = {}
+        self.ssh_target_host = None
+        self.connection = None
+        self._patchset1_ssh = None
+        self._current_patchset_ssh = None
+
+    def set_connection(self, ssh_target_host, connection):
+        self.ssh_target_host = ssh_target_host
+        self.connection = connection
+        self._patchset1_ssh = None
+        self._current_patchset_ssh = None
+
+    def _get_download_cmd(self, ref):
+        download_cmd = f'git clone {self.base_url}/{self.project} -b {self.branch}; cd {self.project_dir}; git pull {self.base_url}/{self.project} {ref} --rebase'
+        if self.connection and not self.connection in download_cmd:
+            # mismatch case
+            download_cmd = ChangeRecord.HTTP_URL_PATTERN.sub("ssh://"+self.ssh_target_host + '/', download_cmd)
+        return download_cmd
+
+    @property
+    def patchset1_ref(self):
+        return f'refs/changes/{self.number[-2:]}/{self.number}/1'
+
+    @property
+    def patchset1_ssh(self):
+        if self._patchset1_ssh == None:
+            self._patchset1_ssh = self._get_download_cmd(self.patchset1_ref)
+        return self._patchset1_ssh
+
+    @property
+    def current_patchset_ssh(self):
+        if self._current_patchset_ssh == None and self.current_patch_set_ref:
+            self._current_patchset_ssh = self._get_download_cmd(self.current_patch_set_ref)
+        return self._current_patchset_ssh
+
+    @property
+    def patchset1_repo(self):
+        return f'repo download {self.project} {self.number}/1'
+
+    # dict compatible accessors for the existing callers
+    KEY_GETTERS = {
+        "number": lambda self: self.number,
+        "Change-Id": lambda self: self.change_id,
+        "subject": lambda self: self.subject,
+        "status": lambda self: self.status,
+        "url": lambda self: self.url,
+        "Created": lambda self: datetime.fromtimestamp(self.created_on),
+        "project_dir": lambda self: self.project_dir,
+        "Last Updated": lambda self: datetime.fromtimestamp(self.last_updated_on),
+        "patchset1_ssh": lambda self: self.patchset1_ssh,
+        "patchset1_repo": lambda self: self.patchset1_repo,
+        "comments": lambda self: self.comments,
+        "current_patchset_ssh": lambda self: self.current_patchset_ssh,
+        "files": lambda self: self.files,
+    }
+    # the keys exist only if the query has the data
+    OPTIONAL_KEYS = {
+        "current_patchset_ssh": lambda self: self.current_patch_set_ref,
+        "files": lambda self: self.files,
+    }
+
+    def keys(self):
+        return [key for key in ChangeRecord.KEY_GETTERS.keys() if key in self]
+
+    def __contains__(self, key):
+        return key in ChangeRecord.KEY_GETTERS and (not key in ChangeRecord.OPTIONAL_KEYS or ChangeRecord.OPTIONAL_KEYS[key](self) != None)
+
+    def __getitem__(self, key):
+        if not key in self:
+            raise KeyError(key)
+        return ChangeRecord.KEY_GETTERS[key](self)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
 
 class GerritUtil:
+    QUERY_PAGE_WORKERS = 4
+    NUMBERS_CHUNK_SIZE = 50
+    NUMBERS_QUERY_WORKERS = 4
+
+    # all query, download and upload go through this if GERRIT_RATE_LIMIT or GERRIT_MAX_SESSIONS is set
+    governor = RateGovernor.from_env()
+    # all git commands run without shell. cancel() stops the running ones.
+    runner = ExecRunner(verbose=True)
+    DOWNLOAD_CMD_PATTERN = re.compile(r'^git clone (\S+) -b (\S+); cd (\S+); git pull (\S+) (\S+) --rebase$')
+    REMOTE_PROJECT_PATTERN = re.compile(r'^[a-z+]+://[^/]+/(.+?)(\.git)?/?$')
+    DATE_WITH_TIMEZONE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} [+-]\d{4}$')
+    # gerrit's virtual files which don't exist in the work tree
+    MAGIC_FILES = ["/COMMIT_MSG", "/MERGE_LIST", "/PATCHSET_LEVEL"]
+    MAX_DEEPEN = 10
+    AUTHOR_PATTERN = re.compile(r'^(.*) <(.*)> (\d+) ([+-]\d{4})$')
+    WORKSPACE_STATE_FILE = "gerrit-util-workspace.json"
+
     @staticmethod
-    def parse_since(since):
+    def set_governor(governor):
+        GerritUtil.governor = governor
+
+    @staticmethod
+    def session():
+        return GerritUtil.governor.session() if GerritUtil.governor else nullcontext()
+
+    @staticmethod
+    def acquire_token():
+        # rate limit only. for the long running stream which shouldn't occupy a session slot.
+        if GerritUtil.governor:
+            GerritUtil.governor.acquire_token()
+
+    @staticmethod
+    def parse_since_date(since):
         if since.endswith('ago'):
             num, unit = since.split()[0:2]
             num = int(num)
@@ -37,141 +188,630 @@ class GerritUtil:
             else:
                 raise ValueError(f"Unsupported time unit: {unit}")
             date = datetime.now() - delta
+        elif GerritUtil.DATE_WITH_TIMEZONE_PATTERN.match(since):
+            date = datetime.fromtimestamp(datetime.strptime(since, "%Y-%m-%d %H:%M:%S %z").timestamp())
         else:
             date = datetime.strptime(since, "%Y-%m-%d")
+        return date
+
+    @staticmethod
+    def parse_since(since):
+        if GerritUtil.DATE_WITH_TIMEZONE_PATTERN.match(since):
+            # already gerrit's date format
+            return since
+        date = GerritUtil.parse_since_date(since)
         return date.strftime("%Y-%m-%d %H:%M:%S +0900")
 
     @staticmethod
-    def _parse_gerrt_result(result_lines):
+    def _add_comment(comments, filename, line, message, reviewer):
+        if not filename in comments:
+            comments[filename] = {}
+        if not line in comments[filename]:
+            comments[filename][line] = []
+        comments[filename][line].append(
+            {
+                "message": message,
+                "reviewer": reviewer
+            }
+        )
+
+    @staticmethod
+    def _get_files(files):
+        result = []
+        for file, old_file in files:
+            # the renamed file needs both paths
+            for _file in [file, old_file]:
+                if _file and not _file in GerritUtil.MAGIC_FILES and not _file in result:
+                    result.append(_file)
+        return result
+
+    @staticmethod
+    def _parse_gerrt_data(data):
         project = None
         branch = None
         theData = {}
 
-        try:
-            data = json.loads(result_lines)
-            if 'project' in data:
-                project = data['project']
-                branch = data['branch']
-
-                id = str(data[('number')])
-                url = data['url']
-                pos = url.find("/c/")
-                pos2 = project.rfind("/")
-                project_dir = project[pos2+1:]
-                theData = {
-                    "number": id,
-                    "Change-Id": data['id'],
-                    "subject": data['subject'],
-                    "status": data['status'],
-                    "url": data['url'],
-                    "Created": datetime.fromtimestamp(data['createdOn']),
-                    "project_dir": project_dir,
-                    "Last Updated": datetime.fromtimestamp(data['lastUpdated']),
-                    "patchset1_ssh": f'git clone {url[0:pos]}/{project} -b {branch}; cd {project_dir}; git pull {url[0:pos]}/{project} refs/changes/{id[len(id)-2:]}/{id}/1 --rebase',
-                    "patchset1_repo": f'repo download {project} {id}/1',
-                    "comments": {}
-                }
-                if "currentPatchSet" in data and "ref" in data["currentPatchSet"]:
-                    current_patch_set_ref = data["currentPatchSet"]["ref"]
-                    theData["current_patchset_ssh"] = f'git clone {url[0:pos]}/{project} -b {branch}; cd {project_dir}; git pull {url[0:pos]}/{project} {current_patch_set_ref} --rebase'
-
-                    if "comments" in data["currentPatchSet"]:
-                        _comments = data["currentPatchSet"]["comments"]
-                        comments = theData["comments"]
-                        for comment in _comments:
-                            filename = comment["file"]
-                            if not filename in comments:
-                                comments[filename] = {}
-                            line = comment["line"]
-                            if not line in comments[filename]:
-                                comments[filename][line] = []
-                            comments[filename][line].append(
-                                {
-                                    "message": comment["message"],
-                                    "reviewer": comment["reviewer"]
-                                }
-                            )
+        if 'project' in data:
+            project = data['project']
+            branch = data['branch']
+
+            id = str(data[('number')])
+            url = data['url']
+            pos = url.find("/c/")
+            current_patch_set_ref = None
+            files = None
+            if "currentPatchSet" in data and "ref" in data["currentPatchSet"]:
+                current_patch_set_ref = data["currentPatchSet"]["ref"]
+                if "files" in data["currentPatchSet"]:
+                    files = GerritUtil._get_files([(file["file"], file.get("fileOld")) for file in data["currentPatchSet"]["files"]])
+            theData = ChangeRecord(url[0:pos], project, branch, id, data['id'], data['subject'], data['status'], url, data['createdOn'], data['lastUpdated'], current_patch_set_ref, files)
 
+            if current_patch_set_ref and "comments" in data["currentPatchSet"]:
+                for comment in data["currentPatchSet"]["comments"]:
+                    GerritUtil._add_comment(theData.comments, comment["file"], comment["line"], comment["message"], comment["reviewer"])
+
+        return project, branch, theData
 
+    @staticmethod
+    def _parse_gerrt_result(result_lines):
+        try:
+            return GerritUtil._parse_gerrt_data(json_loads(result_lines))
         except json.JSONDecodeError:
-            pass
+            return None, None, {}
+
+    @staticmethod
+    def _parse_rest_result(client, data, with_comments=False):
+        project = data['project']
+        branch = data['branch']
+
+        id = str(data['_number'])
+        current_patch_set_ref = None
+        files = None
+        if "current_revision" in data and "revisions" in data:
+            revision = data["revisions"][data["current_revision"]]
+            current_patch_set_ref = revision["ref"]
+            if "files" in revision:
+                files = GerritUtil._get_files([(file, info.get("old_path")) for file, info in revision["files"].items()])
+        theData = ChangeRecord(client.base_url, project, branch, id, data['change_id'], data['subject'], data['status'], f'{client.base_url}/c/{project}/+/{id}', client.parse_timestamp(data['created']), client.parse_timestamp(data['updated']), current_patch_set_ref, files)
+
+        if with_comments and current_patch_set_ref:
+            with GerritUtil.session():
+                _all_comments = client.get_comments(id)
+            for filename, _comments in _all_comments.items():
+                for comment in _comments:
+                    # file level comment doesn't have line
+                    GerritUtil._add_comment(theData.comments, filename, comment.get("line", 0), comment["message"], comment.get("author", {}))
 
         return project, branch, theData
 
+    @staticmethod
+    def get_rest_client(ssh_target_host):
+        from GerritRestUtil import GerritRestClient
+        base_url = ssh_target_host if ssh_target_host.startswith(("http://", "https://")) else os.getenv("GERRIT_URL", f'http://{ssh_target_host}')
+        return GerritRestClient.get_client(base_url, os.getenv("GERRIT_USER"), os.getenv("GERRIT_HTTP_PASSWORD"))
 
     @staticmethod
-    def query(ssh_target_host, branch, status, since, numbers, extra_commands=[], connection="http", filter_git=None):
-        result = {}
+    def _iter_query_rest(client, query, options, with_comments, start, stats):
+        with GerritUtil.session():
+            results = client.query_changes(query, options, start)
+        stats["rowCount"] = len(results)
+        stats["moreChanges"] = results[-1].get("_more_changes", False) if results else False
+        for data in results:
+            yield GerritUtil._parse_rest_result(client, data, with_comments)
+
+    @staticmethod
+    def _iter_query_ssh(cmd, start, stats):
+        if start:
+            cmd = cmd + ["--start", str(start)]
+        # the query streams while the caller downloads or uploads the results. taking a session slot
+        # here would deadlock with GERRIT_MAX_SESSIONS=1, so only the rate is limited.
+        GerritUtil.acquire_token()
+        proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            for line in proc.stdout:
+                try:
+                    data = json_loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if data.get("type") == "stats":
+                    # the last line tells if the result is truncated by the server's limit
+                    stats["rowCount"] = data.get("rowCount", 0)
+                    stats["moreChanges"] = data.get("moreChanges", False)
+                else:
+                    yield GerritUtil._parse_gerrt_data(data)
+        finally:
+            # the caller may stop iterating before gerrit finishes serializing
+            if proc.poll() is None:
+                proc.terminate()
+            proc.stdout.close()
+            proc.wait()
+
+    @staticmethod
+    def _fetch_page(iter_page, start):
+        stats = {}
+        results = list(iter_page(start, stats))
+        return results, stats
+
+    @staticmethod
+    def _iter_pages(iter_page, max_rows=None, page_workers=QUERY_PAGE_WORKERS):
+        # iter_page(start, stats) yields (project, branch, theData) of the page and sets stats
+        found_numbers = set()
+        count = 0
+
+        def _new_results(results):
+            nonlocal count
+            for project, branch, theData in results:
+                if max_rows and count >= max_rows:
+                    return
+                if project:
+                    # the result may shift between pages if a change is updated while paging
+                    if theData["number"] in found_numbers:
+                        continue
+                    found_numbers.add(theData["number"])
+                    count += 1
+                yield project, branch, theData
+
+        stats = {}
+        yield from _new_results(iter_page(0, stats))
+        page_size = stats.get("rowCount", 0)
+        more_changes = stats.get("moreChanges", False)
+        start = page_size
+
+        if more_changes and page_size:
+            # --start pages are independent so fetch the following pages concurrently
+            page_workers = max(1, page_workers)
+            with ThreadPoolExecutor(max_workers=page_workers) as executor:
+                while more_changes and (not max_rows or count < max_rows):
+                    starts = [start + page_size * i for i in range(page_workers)]
+                    futures = [executor.submit(GerritUtil._fetch_page, iter_page, _start) for _start in starts]
+                    for future in futures:
+                        results, stats = future.result()
+                        yield from _new_results(results)
+                        more_changes = stats.get("moreChanges", False) and stats.get("rowCount", 0) > 0
+                        if not more_changes or (max_rows and count >= max_rows):
+                            break
+                    start = starts[-1] + page_size
+
+    @staticmethod
+    def _new_iter_page(ssh_target_host, connection, query_terms, extra_commands=[]):
+        if connection == "rest":
+            client = GerritUtil.get_rest_client(ssh_target_host)
+            options = ["CURRENT_REVISION"]
+            for extra_command in extra_commands:
+                option = client.SSH_OPTION_MAPPER.get(extra_command)
+                if option and not option in options:
+                    options.append(option)
+            query = " ".join(query_terms)
+            with_comments = "--comments" in extra_commands
+            return lambda start, stats: GerritUtil._iter_query_rest(client, query, options, with_comments, start, stats)
+        else:
+            cmd = SshUtil.get_ssh_command() + [
+                ssh_target_host, 'gerrit', 'query', '--format=json'
+            ] + query_terms + extra_commands
+            return lambda start, stats: GerritUtil._iter_query_ssh(cmd, start, stats)
+
+    @staticmethod
+    def _iter_query_numbers(ssh_target_host, connection, numbers, extra_commands=[], max_rows=None, page_workers=QUERY_PAGE_WORKERS):
+        # too many numbers break the command line and are serialized in one server side query
+        iter_pages = []
+        for i in range(0, len(numbers), GerritUtil.NUMBERS_CHUNK_SIZE):
+            query_terms = " OR ".join(numbers[i:i+GerritUtil.NUMBERS_CHUNK_SIZE]).split(" ")
+            iter_pages.append(GerritUtil._new_iter_page(ssh_target_host, connection, query_terms, extra_commands))
+
+        if len(iter_pages) == 1:
+            yield from GerritUtil._iter_pages(iter_pages[0], max_rows, page_workers)
+        else:
+            count = 0
+            with ThreadPoolExecutor(max_workers=GerritUtil.NUMBERS_QUERY_WORKERS) as executor:
+                futures = [executor.submit(lambda iter_page: list(GerritUtil._iter_pages(iter_page, None, 1)), iter_page) for iter_page in iter_pages]
+                # merge the group results in the order of the groups
+                for future in futures:
+                    for project, branch, theData in future.result():
+                        if max_rows and count >= max_rows:
+                            return
+                        count += 1
+                        yield project, branch, theData
+
+    @staticmethod
+    def iter_query(ssh_target_host, branch, status, since, numbers, extra_commands=[], connection="http", filter_git=None, max_rows=None, page_workers=QUERY_PAGE_WORKERS):
         status_query = ' OR '.join(f'status:{s}' for s in status.split('|'))
         since_date = GerritUtil.parse_since(since)
         if filter_git:
             filter_git=re.compile(filter_git)
 
-        cmd = [
-            'ssh', ssh_target_host, 'gerrit', 'query', '--format=json'
-        ]
-        is_number = False
-        for number in numbers:
-            if number:
-                cmd.append(number)
-                is_number = True
-
-        if not is_number:
-            cmd.extend([
+        numbers = [number for number in numbers if number]
+        if numbers:
+            results = GerritUtil._iter_query_numbers(ssh_target_host, connection, numbers, extra_commands, max_rows, page_workers)
+        elif connection == "rest":
+            iter_page = GerritUtil._new_iter_page(ssh_target_host, connection, [f'branch:{branch}', f'AND ({status_query})', f'AND after:"{since_date}"'], extra_commands)
+            results = GerritUtil._iter_pages(iter_page, max_rows, page_workers)
+        else:
+            iter_page = GerritUtil._new_iter_page(ssh_target_host, connection, [
                 f'branch:{branch}',
                 f'AND ({status_query})',
                 f'\'AND after:\"{since_date}\"\'',
-            ])
+            ], extra_commands)
+            results = GerritUtil._iter_pages(iter_page, max_rows, page_workers)
 
-        if extra_commands:
-            cmd.extend(extra_commands)
+        if connection == "rest":
+            # REST backend downloads via the same http server
+            connection = "http"
 
-        _result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        for line in _result.stdout.splitlines():
-            project, branch, theData = GerritUtil._parse_gerrt_result(line)
+        for project, branch, theData in results:
             if project and (not filter_git or filter_git.match(project)):
-                if not project in result:
-                    result[project] = {}
-                if not branch in result[project]:
-                    result[project][branch] = []
-
-                if "current_patchset_ssh" in theData:
-                    current_patchset_ssh = theData["current_patchset_ssh"]
-                    if not connection in current_patchset_ssh:
-                        # mismatch case
-                        theData["current_patchset_ssh"] = re.sub(r'http://[^/]+/', "ssh://"+ssh_target_host + '/', current_patchset_ssh)
-                if "patchset1_ssh" in theData:
-                    patchset1_ssh = theData["patchset1_ssh"]
-                    if not connection in patchset1_ssh:
-                        # mismatch case
-                        theData["patchset1_ssh"] = re.sub(r'http://[^/]+/', "ssh://"+ssh_target_host + '/', patchset1_ssh)
-                result[project][branch].append(theData)
+                theData.set_connection(ssh_target_host, connection)
+                yield project, branch, theData
+
+    @staticmethod
+    def stream_events(ssh_target_host, event_types=[]):
+        cmd = SshUtil.get_ssh_command() + [ssh_target_host, 'gerrit', 'stream-events']
+        for event_type in event_types:
+            cmd.extend(['--subscribe', event_type])
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            for line in proc.stdout:
+                try:
+                    event = json_loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not event_types or event.get("type") in event_types:
+                    yield event
+        finally:
+            if proc.poll() is None:
+                proc.terminate()
+            proc.stdout.close()
+            proc.wait()
+
+    @staticmethod
+    def group_results(results):
+        result = {}
+
+        for project, branch, theData in results:
+            if not project in result:
+                result[project] = {}
+            if not branch in result[project]:
+                result[project][branch] = []
+            result[project][branch].append(theData)
 
         return result
 
     @staticmethod
-    def download(base_dir, id, download_cmd, force_renew = False):
+    def ungroup_results(result):
+        for project, data in result.items():
+            for branch, theData in data.items():
+                for _data in theData:
+                    yield project, branch, _data
+
+    @staticmethod
+    def query(ssh_target_host, branch, status, since, numbers, extra_commands=[], connection="http", filter_git=None, max_rows=None, page_workers=QUERY_PAGE_WORKERS):
+        return GerritUtil.group_results(GerritUtil.iter_query(ssh_target_host, branch, status, since, numbers, extra_commands, connection, filter_git, max_rows, page_workers))
+
+    @staticmethod
+    def parse_download_cmd(download_cmd):
+        result = None
+        m = GerritUtil.DOWNLOAD_CMD_PATTERN.match(download_cmd.strip())
+        if m:
+            result = {
+                "remote": m.group(1),
+                "branch": m.group(2),
+                "project_dir": m.group(3),
+                "ref": m.group(5),
+            }
+        return result
+
+    @staticmethod
+    def update_mirror(mirror_dir, remote, branch, ref):
+        m = GerritUtil.REMOTE_PROJECT_PATTERN.match(remote)
+        project = m.group(1) if m else os.path.basename(remote)
+        mirror_path = os.path.join(mirror_dir, project + ".git")
+        os.makedirs(os.path.dirname(mirror_path), exist_ok=True)
+
+        # the mirror is shared by the parallel downloads and the other processes
+        with open(mirror_path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(mirror_path):
+                GerritUtil.runner.run(["git", "init", "--bare", mirror_path])
+            # fetch only the branch and the change ref. the others are already in the mirror.
+            GerritUtil.runner.run(["git", "fetch", remote, f'+refs/heads/{branch}:refs/heads/{branch}', f'+{ref}:{ref}'], mirror_path)
+
+        return mirror_path
+
+    @staticmethod
+    def _set_sparse_checkout(current_dir, sparse_files):
+        if sparse_files:
+            # anchor the path to the top since --no-cone pattern is same as .gitignore
+            GerritUtil.runner.run(["git", "sparse-checkout", "set", "--no-cone"] + ["/" + file for file in sparse_files], current_dir)
+
+    @staticmethod
+    def get_sparse_files(theData):
+        # the files of the change (--files) and the commented files
+        result = list(theData.get("files") or [])
+        for file in theData.get("comments", {}).keys():
+            if not file in GerritUtil.MAGIC_FILES and not file in result:
+                result.append(file)
+        return result
+
+    @staticmethod
+    def _has_merge_base(current_dir, commit1, commit2):
+        return GerritUtil.runner.run(["git", "merge-base", commit1, commit2], current_dir, verbose=False).ok
+
+    @staticmethod
+    def _get_fetch_heads(current_dir):
+        result = []
+        try:
+            with open(os.path.join(current_dir, ".git", "FETCH_HEAD"), encoding="utf-8") as f:
+                for line in f:
+                    sha = line.split("\t")[0].strip()
+                    if sha:
+                        result.append(sha)
+        except OSError:
+            pass
+        return result
+
+    @staticmethod
+    def _fetch_change(current_dir, source, download, depth=0):
+        # fetch only the missing objects of the change and the branch. return their sha.
+        depth_option = [f'--depth={depth}'] if depth else []
+        refs = [download["ref"], f'refs/heads/{download["branch"]}']
+        GerritUtil.runner.run(["git", "fetch"] + depth_option + [source] + refs, current_dir)
+        fetch_heads = GerritUtil._get_fetch_heads(current_dir)
+        if depth and len(fetch_heads) == 2:
+            # the shallow history needs to reach the merge base
+            for _ in range(GerritUtil.MAX_DEEPEN):
+                if GerritUtil._has_merge_base(current_dir, fetch_heads[0], fetch_heads[1]):
+                    break
+                GerritUtil.runner.run(["git", "fetch", f'--deepen={depth}', source] + refs, current_dir)
+        return tuple(fetch_heads) if len(fetch_heads) == 2 else (None, None)
+
+    @staticmethod
+    def _get_state_path(current_dir):
+        return os.path.join(current_dir, ".git", GerritUtil.WORKSPACE_STATE_FILE)
+
+    @staticmethod
+    def _load_state(current_dir):
+        try:
+            with open(GerritUtil._get_state_path(current_dir), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _save_state(current_dir, download, ref_sha, branch_sha):
+        state = {"ref": download["ref"], "ref_sha": ref_sha, "branch_sha": branch_sha}
+        with open(GerritUtil._get_state_path(current_dir), "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        return state
+
+    @staticmethod
+    def _rebase_onto_change(current_dir, download, ref_sha, branch_sha):
+        # same result as git clone -b branch; git pull ref --rebase
+        if not GerritUtil.runner.run(["git", "checkout", "-f", "-B", download["branch"], branch_sha], current_dir).ok:
+            raise RuntimeError(f'git checkout {download["branch"]} failed in {current_dir}')
+        # the rebase stops with the merge conflict. it's not an error.
+        GerritUtil.runner.run(["git", "rebase", ref_sha], current_dir)
+        GerritUtil._save_state(current_dir, download, ref_sha, branch_sha)
+
+    @staticmethod
+    def _is_in_progress(current_dir):
+        git_dir = os.path.join(current_dir, ".git")
+        return any(os.path.exists(os.path.join(git_dir, name)) for name in ["rebase-merge", "rebase-apply", "MERGE_HEAD", "CHERRY_PICK_HEAD"])
+
+    @staticmethod
+    def refresh(current_dir, download, source, force_renew=False, depth=0):
+        ref_sha, branch_sha = GerritUtil._fetch_change(current_dir, source, download, depth)
+        if not ref_sha:
+            raise RuntimeError(f'git fetch {download["ref"]} failed in {current_dir}')
+        state = GerritUtil._load_state(current_dir)
+        if not force_renew and state and state.get("ref_sha") == ref_sha and state.get("branch_sha") == branch_sha:
+            # the workspace is already for the patchset
+            return current_dir
+
+        # discard the previous result but keep the object database
+        if GerritUtil._is_in_progress(current_dir):
+            for command in ["rebase", "merge", "cherry-pick"]:
+                GerritUtil.runner.run(["git", command, "--abort"], current_dir, verbose=False)
+        GerritUtil.runner.run(["git", "clean", "-fd"], current_dir, verbose=False)
+        GerritUtil._rebase_onto_change(current_dir, download, ref_sha, branch_sha)
+        return current_dir
+
+    @staticmethod
+    def _download_with_mirror(target_folder, download, mirror_dir, sparse_files=None, force_renew=False):
+        mirror_path = GerritUtil.update_mirror(mirror_dir, download["remote"], download["branch"], download["ref"])
+        current_dir = os.path.join(target_folder, download["project_dir"])
+        if os.path.exists(os.path.join(current_dir, ".git")):
+            return GerritUtil.refresh(current_dir, download, mirror_path, force_renew)
+
+        # share the objects with the mirror instead of cloning from the server
+        if not GerritUtil.runner.run(["git", "clone", "--shared", "--no-checkout", "-b", download["branch"], mirror_path, download["project_dir"]], target_folder).ok:
+            raise RuntimeError(f'git clone {mirror_path} failed')
+        GerritUtil.runner.run(["git", "remote", "set-url", "origin", download["remote"]], current_dir)
+        GerritUtil._set_sparse_checkout(current_dir, sparse_files)
+        ref_sha, branch_sha = GerritUtil._fetch_change(current_dir, mirror_path, download)
+        if not ref_sha:
+            raise RuntimeError(f'git fetch {download["ref"]} failed in {current_dir}')
+        GerritUtil._rebase_onto_change(current_dir, download, ref_sha, branch_sha)
+        return current_dir
+
+    @staticmethod
+    def _download_partial(target_folder, download, sparse_files, depth):
+        current_dir = os.path.join(target_folder, download["project_dir"])
+        remote = download["remote"]
+        depth_option = [f'--depth={depth}'] if depth else []
+        # blobs are fetched on demand and only the sparse files are checked out
+        if not GerritUtil.runner.run(["git", "clone", "--filter=blob:none", "--no-checkout"] + depth_option + ["-b", download["branch"], remote, download["project_dir"]], target_folder).ok:
+            raise RuntimeError(f'git clone {remote} failed')
+        GerritUtil._set_sparse_checkout(current_dir, sparse_files)
+        ref_sha, branch_sha = GerritUtil._fetch_change(current_dir, remote, download, depth)
+        if not ref_sha:
+            raise RuntimeError(f'git fetch {download["ref"]} failed in {current_dir}')
+        GerritUtil._rebase_onto_change(current_dir, download, ref_sha, branch_sha)
+        return current_dir
+
+    @staticmethod
+    def _download_with_clone(target_folder, download_cmd):
+        current_dir = GerritUtil.runner.run_script(download_cmd, target_folder)
+        # git pull --rebase fails with the merge conflict. check the clone and the fetch instead of the exit code.
+        if not os.path.exists(os.path.join(current_dir, ".git")):
+            raise RuntimeError(f'{download_cmd} failed')
+        download = GerritUtil.parse_download_cmd(download_cmd)
+        if download:
+            # record the state for the later refresh. FETCH_HEAD has the change.
+            fetch_heads = GerritUtil._get_fetch_heads(current_dir)
+            if not fetch_heads:
+                raise RuntimeError(f'git pull {download["ref"]} failed in {current_dir}')
+            branch_sha = GerritUtil.runner.run(["git", "rev-parse", f'refs/remotes/origin/{download["branch"]}'], current_dir, verbose=False).stdout.strip()
+            GerritUtil._save_state(current_dir, download, fetch_heads[0], branch_sha)
+        return current_dir
+
+    @staticmethod
+    def download(base_dir, id, download_cmd, force_renew = False, mirror_dir = None, sparse_files = None, depth = 0):
         target_folder = os.path.join(base_dir, str(id))
+        download = GerritUtil.parse_download_cmd(download_cmd)
+        current_dir = os.path.join(target_folder, download["project_dir"]) if download else target_folder
+        is_workspace = download and os.path.exists(os.path.join(current_dir, ".git"))
 
-        # remove folder if force_renew
-        if force_renew and os.path.exists(target_folder):
+        # remove folder if force_renew and the workspace can't be refreshed
+        if force_renew and not is_workspace and os.path.exists(target_folder):
             shutil.rmtree(target_folder)
 
         # ensure target_folder
         os.makedirs(target_folder, exist_ok=True)
-        current_dir = target_folder
 
-        current_dir = ExecUtil.exec_cmd_with_cd(download_cmd, target_folder)
+        with GerritUtil.session():
+            if download and mirror_dir:
+                current_dir = GerritUtil._download_with_mirror(target_folder, download, mirror_dir, sparse_files, force_renew)
+            elif is_workspace:
+                # fetch only the new patchset instead of rmtree and clone again
+                current_dir = GerritUtil.refresh(current_dir, download, download["remote"], force_renew, depth)
+            elif download and (sparse_files != None or depth):
+                current_dir = GerritUtil._download_partial(target_folder, download, sparse_files, depth)
+            else:
+                current_dir = GerritUtil._download_with_clone(target_folder, download_cmd)
 
         return current_dir
 
     @staticmethod
-    def upload(target_folder, branch):
-        upload_cmd = f"git add *; git commit --amend --no-edit; git push origin HEAD:refs/for/{branch}"
+    def get_push_remote(target_folder):
+        # the remote of repo workspace is named in the manifest
+        remotes = GerritUtil.runner.run(["git", "remote"], target_folder, verbose=False).get_lines()
+        return remotes[0] if remotes and not "origin" in remotes else "origin"
 
+    @staticmethod
+    def _parse_commit(raw_commit):
+        # git cat-file commit: headers, an empty line and the message
+        headers, _, message = raw_commit.partition("\n\n")
+        parents = []
+        author = None
+        for line in headers.split("\n"):
+            if line.startswith("parent "):
+                parents.append(line[7:])
+            elif line.startswith("author "):
+                author = line[7:]
+        return parents, author, message
+
+    @staticmethod
+    def _get_author_env(author):
+        # e.g. Name <name@example.com> 1700000000 +0900
+        m = GerritUtil.AUTHOR_PATTERN.match(author) if author else None
+        if not m:
+            return {}
+        return {"GIT_AUTHOR_NAME": m.group(1), "GIT_AUTHOR_EMAIL": m.group(2), "GIT_AUTHOR_DATE": f'@{m.group(3)} {m.group(4)}'}
+
+    @staticmethod
+    def _commit_amend_files(target_folder, files):
+        # same as git add files; git commit --amend --no-edit without scanning the work tree
+        # the files are the paths from the current directory e.g. os.path.join(target_folder, file)
+        paths = [os.path.relpath(os.path.abspath(file), os.path.abspath(target_folder)) for file in files]
+        if paths:
+            # --remove: the deleted file is removed from the index
+            if not GerritUtil.runner.run(["git", "update-index", "--add", "--remove", "--"] + paths, target_folder).ok:
+                return None
+        result = GerritUtil.runner.run(["git", "write-tree"], target_folder, verbose=False)
+        if not result.ok:
+            # e.g. unmerged paths are remaining
+            print(f'Failed to write tree in {target_folder}: {result.stderr.strip()}')
+            return None
+        tree = result.stdout.strip()
+
+        result = GerritUtil.runner.run(["git", "cat-file", "commit", "HEAD"], target_folder, verbose=False)
+        if not result.ok:
+            return None
+        parents, author, message = GerritUtil._parse_commit(result.stdout)
+        parent_options = []
+        for parent in parents:
+            parent_options.extend(["-p", parent])
+        result = GerritUtil.runner.run(["git", "commit-tree", tree] + parent_options, target_folder, verbose=False, input=message, env=GerritUtil._get_author_env(author))
+        if not result.ok:
+            print(f'Failed to commit in {target_folder}: {result.stderr.strip()}')
+            return None
+        sha = result.stdout.strip()
+
+        subject = message.split("\n", 1)[0]
+        GerritUtil.runner.run(["git", "update-ref", "-m", f'commit (amend): {subject}', "HEAD", sha], target_folder)
+        return sha
+
+    @staticmethod
+    def commit_amend(target_folder, files=None):
+        # files: the modified files. None is same as git add * of shell.
+        if files != None:
+            return GerritUtil._commit_amend_files(target_folder, files)
+        # the hidden files are not included.
+        files = sorted(file for file in os.listdir(target_folder) if not file.startswith("."))
+        GerritUtil.runner.run(["git", "add", "--"] + files, target_folder)
+        GerritUtil.runner.run(["git", "commit", "--amend", "--no-edit"], target_folder)
+        result = GerritUtil.runner.run(["git", "rev-parse", "HEAD"], target_folder, verbose=False)
+        return result.stdout.strip() if result.ok else None
+
+    @staticmethod
+    def upload(target_folder, branch, files=None):
         # check the target_folder is git folder
         if os.path.exists(os.path.join(target_folder+"/.git")):
-            ExecUtil.exec_cmd_with_cd(upload_cmd, target_folder)
+            remote = GerritUtil.get_push_remote(target_folder)
+            with GerritUtil.session():
+                GerritUtil.commit_amend(target_folder, files)
+                GerritUtil.runner.run(["git", "push", remote, f'HEAD:refs/for/{branch}'], target_folder)
 
         return target_folder
+
+    @staticmethod
+    def parse_labels(labels):
+        # e.g. ["Code-Review=+1", "Verified=-1"] -> {"Code-Review": 1, "Verified": -1}
+        result = {}
+        for label in labels:
+            name, value = label.split("=", 1)
+            result[name.strip()] = int(value)
+        return result
+
+    @staticmethod
+    def review(ssh_target_host, changes, labels=[], message=None, connection="ssh"):
+        # changes: [(number, revision)]. post the same labels and message to all the changes.
+        if not changes or (not labels and not message):
+            return True
+        if connection == "rest":
+            client = GerritUtil.get_rest_client(ssh_target_host)
+            review = {}
+            if message:
+                review["message"] = message
+            if labels:
+                review["labels"] = GerritUtil.parse_labels(labels)
+            # no batch endpoint in REST. the requests share the keep-alive connection.
+            result = True
+            with GerritUtil.session():
+                for number, revision in changes:
+                    try:
+                        client.set_review(number, revision, review)
+                    except Exception as e:
+                        print(f'Failed to review {number}: {e}')
+                        result = False
+            return result
+
+        # gerrit review accepts several commits in one ssh session
+        cmd = SshUtil.get_ssh_command() + [ssh_target_host, "gerrit", "review"]
+        if message:
+            # the arguments are parsed again by gerrit's ssh daemon
+            cmd.extend(["--message", shlex.quote(message)])
+        for label in labels:
+            cmd.extend(["--label", label])
+        cmd.extend(revision for number, revision in changes)
+        with GerritUtil.session():
+            return GerritUtil.runner.run(cmd).ok
@@ -0,0 +1,162 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import threading
+import pygit2
+
+class Pygit2Backend:
+    # git diff option -> libgit2 diff flag
+    DIFF_OPTION_MAPPER = {
+        "--ignore-space-at-eol": "IGNORE_WHITESPACE_EOL",
+        "--ignore-space-change": "IGNORE_WHITESPACE_CHANGE",
+        "--ignore-all-space": "IGNORE_WHITESPACE",
+        # libgit2 doesn't have --ignore-cr-at-eol. the cr is a whitespace at eol.
+        "--ignore-cr-at-eol": "IGNORE_WHITESPACE_EOL",
+    }
+
+    def __init__(self):
+        self.repos = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _get_flag(prefix, enum_name, name):
+        # pygit2 >= 1.14 has the flags as enum
+        value = getattr(pygit2, f'{prefix}_{name}', None)
+        if value == None:
+            value = getattr(getattr(pygit2.enums, enum_name), name)
+        return int(value)
+
+    @staticmethod
+    def _get_status_flag(name):
+        return Pygit2Backend._get_flag("GIT_STATUS", "FileStatus", name)
+
+    def get_repo(self, gitPath):
+        # open the repository once per work tree
+        path = os.path.abspath(gitPath)
+        with self.lock:
+            if not path in self.repos:
+                repo_path = pygit2.discover_repository(path)
+                self.repos[path] = pygit2.Repository(repo_path) if repo_path else None
+            return self.repos[path]
+
+    def _to_repo_path(self, repo, gitPath, path):
+        return os.path.relpath(os.path.join(os.path.abspath(gitPath), path), repo.workdir).replace(os.sep, "/")
+
+    def _to_git_path(self, repo, gitPath, path):
+        # git status prints the path relative to the current directory
+        return os.path.relpath(os.path.join(repo.workdir, path), os.path.abspath(gitPath))
+
+    def status(self, gitPath):
+        repo = self.get_repo(gitPath)
+        if not repo:
+            return None
+
+        staged = Pygit2Backend._get_status_flag("INDEX_MODIFIED") | Pygit2Backend._get_status_flag("INDEX_NEW")
+        not_staged = Pygit2Backend._get_status_flag("WT_MODIFIED")
+        untracked = Pygit2Backend._get_status_flag("WT_NEW")
+        conflicted = Pygit2Backend._get_status_flag("CONFLICTED")
+        deleted = Pygit2Backend._get_status_flag("WT_DELETED")
+
+        result_to_be_commited = []
+        result_changes_not_staged = []
+        result_untracked = []
+        try:
+            # untracked directory is reported as dir/ same as git status
+            status = repo.status(untracked_files="normal")
+        except TypeError:
+            status = repo.status()
+        for path, flags in status.items():
+            aFile = self._to_git_path(repo, gitPath, path)
+            if path.endswith("/"):
+                aFile += "/"
+            # same as GitUtil.status. the unmerged paths are listed with the changes to be committed.
+            if flags & deleted:
+                # GitUtil.status drops the files which don't exist
+                continue
+            elif flags & (staged | conflicted):
+                result_to_be_commited.append(aFile)
+            elif flags & not_staged:
+                result_changes_not_staged.append(aFile)
+            elif flags & untracked:
+                result_untracked.append(aFile)
+
+        all_modified = list(set(result_to_be_commited + result_changes_not_staged + result_untracked))
+        return all_modified, result_to_be_commited, result_changes_not_staged, result_untracked
+
+    def diff(self, gitPath, options):
+        # return None if the options are not supported. the caller uses git command instead.
+        repo = self.get_repo(gitPath)
+        if not repo:
+            return None
+
+        flags = 0
+        cached = False
+        revision = None
+        paths = []
+        for option in options:
+            if option in Pygit2Backend.DIFF_OPTION_MAPPER:
+                flags |= Pygit2Backend._get_flag("GIT_DIFF", "DiffOption", Pygit2Backend.DIFF_OPTION_MAPPER[option])
+            elif option in ["--cached", "--staged"]:
+                cached = True
+            elif option == "--":
+                continue
+            elif option.startswith("-"):
+                return None
+            elif revision == None and not paths and not os.path.exists(os.path.join(gitPath, option)):
+                revision = option
+            else:
+                paths.append(self._to_repo_path(repo, gitPath, option))
+
+        if cached and not revision:
+            revision = "HEAD"
+        elif revision and not cached:
+            # git diff <rev> compares with the work tree through the index. libgit2's tree to workdir ignores the index.
+            return None
+
+        repo.index.read()
+        conflicts = repo.index.conflicts
+        if conflicts:
+            # the combined diff of the unmerged path is only available with git command
+            for conflict in conflicts:
+                for entry in conflict:
+                    if entry and (not paths or entry.path in paths):
+                        return None
+
+        try:
+            if revision:
+                diff = repo.diff(revision, None, cached, flags)
+            else:
+                diff = repo.diff(None, None, cached, flags)
+        except (KeyError, ValueError, pygit2.GitError):
+            return None
+
+        result = []
+        for patch in diff:
+            delta = patch.delta
+            if not paths or delta.new_file.path in paths or delta.old_file.path in paths:
+                text = patch.text
+                if text:
+                    result.extend(text.splitlines())
+        return result
+
+    def read_blob(self, gitPath, path, rev="HEAD"):
+        repo = self.get_repo(gitPath)
+        if not repo:
+            return None
+        try:
+            blob = repo.revparse_single(f'{rev}:{self._to_repo_path(repo, gitPath, path)}')
+        except (KeyError, ValueError, pygit2.GitError):
+            return None
+        return blob.data.decode("utf-8", errors="replace").splitlines()
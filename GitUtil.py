@@ -12,75 +12,321 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from ExecUtil import ExecUtil
+from ExecUtil import ExecRunner
 import os
-import subprocess
+import re
+import shlex
+import threading
+
+class GitDiff:
+    HUNK_HEADER_PATTERN = re.compile(r'^@@+ (.+?) @@+')
+
+    def __init__(self, lines, prefix=""):
+        # the paths of git diff are relative to the top of the work tree
+        self.prefix = prefix
+        self.files = GitDiff.parse(lines)
+
+    @staticmethod
+    def _unquote(path):
+        if path.startswith('"') and path.endswith('"'):
+            # core.quotePath escapes non-ascii as octal
+            path = path[1:-1].encode("latin-1", errors="backslashreplace").decode("unicode_escape").encode("latin-1").decode("utf-8", errors="replace")
+        return path
+
+    @staticmethod
+    def _get_path_from_header(line):
+        if line.startswith("diff --git "):
+            header = line[len("diff --git "):]
+            if header.endswith('"'):
+                path = GitDiff._unquote(header[header.rfind(' "')+1:])
+            else:
+                path = header[header.rfind(" b/")+1:]
+            return path[2:] if path.startswith("b/") else path
+        # diff --cc path or diff --combined path
+        return GitDiff._unquote(line.split(" ", 2)[2])
+
+    @staticmethod
+    def parse_hunk_header(line):
+        # "@@ -a,b +c,d @@" or "@@@ -a,b -c,d +e,f @@@" for the combined diff
+        hunk = {"header": line, "old": [], "new_start": None, "new_count": None, "lines": []}
+        m = GitDiff.HUNK_HEADER_PATTERN.match(line)
+        if m:
+            for _range in m.group(1).split(" "):
+                values = _range[1:].split(",")
+                start = int(values[0])
+                count = int(values[1]) if len(values) > 1 else 1
+                if _range.startswith("+"):
+                    hunk["new_start"] = start
+                    hunk["new_count"] = count
+                else:
+                    hunk["old"].append([start, count])
+        return hunk
+
+    @staticmethod
+    def parse(lines):
+        result = {}
+        current = None
+        current_path = None
+        hunk = None
+        for line in lines:
+            if line.startswith(("diff --git ", "diff --cc ", "diff --combined ")):
+                current = {"lines": [], "hunks": []}
+                hunk = None
+                current_path = GitDiff._get_path_from_header(line)
+                result[current_path] = current
+            elif current == None:
+                continue
+            elif hunk == None and line.startswith("+++ ") and line != "+++ /dev/null":
+                # more reliable than the header if the path has " b/". git adds tab after the path with space.
+                path = GitDiff._unquote(line[4:].rstrip("\t"))
+                path = path[2:] if path.startswith("b/") else path
+                if path != current_path:
+                    del result[current_path]
+                    current_path = path
+                    result[current_path] = current
+            elif line.startswith("@@"):
+                hunk = GitDiff.parse_hunk_header(line)
+                current["hunks"].append(hunk)
+            elif hunk != None:
+                hunk["lines"].append(line)
+            if current != None:
+                current["lines"].append(line)
+        return result
+
+    def _to_diff_path(self, path):
+        return os.path.normpath(os.path.join(self.prefix, path)).replace(os.sep, "/")
+
+    def get_paths(self):
+        return list(self.files.keys())
+
+    def get_lines(self, path):
+        # same as the result of GitUtil.diff for the path
+        file = self.files.get(self._to_diff_path(path))
+        return file["lines"] if file else []
+
+    def get_hunks(self, path):
+        file = self.files.get(self._to_diff_path(path))
+        return file["hunks"] if file else []
+
 
 class GitUtil:
-    STATUS_CHANGES_TO_BE_COMMITED = 0
-    STATUS_CHANGES_TO_BE_COMMITED_IDENTIFIER = "Changes to be committed:"
+    # git status --porcelain=v2 entry types
+    STATUS_ORDINARY = "1"
+    STATUS_RENAMED = "2"
+    STATUS_UNMERGED = "u"
+    STATUS_UNTRACKED = "?"
+    STATUS_IGNORED = "!"
 
-    STATUS_CHANGES_NOT_STAGED = 1
-    STATUS_CHANGES_NOT_STAGED_IDENTIFIER = "Changes not staged for commit:"
-    STATUS_CHANGES_MODIFIED = "modified:"
-    STATUC_CHANGES_NEWFILE = "new file:"
-    STATUS_CHANGES_MODIFIED_LEN = len(STATUS_CHANGES_MODIFIED)
+    runner = ExecRunner()
+    DIFF_CACHE_SIZE = 256
+    _diff_cache = {}
+    _diff_cache_lock = threading.Lock()
+    # in-process backend (e.g. pygit2). git command is used if None or the backend doesn't support the request.
+    backend = None
 
-    STATUS_UNTRACKED = 2
-    STATUS_UNTRACKED_IDENTIFIER = "Untracked files:"
+    @staticmethod
+    def set_backend(name):
+        GitUtil.backend = None
+        if name == "pygit2":
+            try:
+                from GitBackend import Pygit2Backend
+                GitUtil.backend = Pygit2Backend()
+            except ImportError:
+                print("pygit2 is not available. git command is used instead.")
 
-    STATUS_IGNORE_OTHERS = [
-        '(use "git restore --staged <file>..." to unstage)',
-        '(use "git add <file>..." to update what will be committed)',
-        '(use "git add <file>..." to include in what will be committed)',
-        '(use "git restore <file>..." to discard changes in working directory)',
-        'no changes added to commit (use "git add" and/or "git commit -a")'
-    ]
+    @staticmethod
+    def _get_options(gitOpt):
+        if not gitOpt:
+            return []
+        return list(gitOpt) if isinstance(gitOpt, (list, tuple)) else shlex.split(gitOpt)
 
     @staticmethod
-    def status(gitPath, gitOpt=""):
-        result_to_be_commited = []
-        result_changes_not_staged = []
-        result_untracked = []
-
-        exec_cmd = f"git status {gitOpt if gitOpt else ''}"
-        result = ExecUtil.getExecResultEachLine(exec_cmd, gitPath, False, True, True)
-
-        mode = GitUtil.STATUS_CHANGES_TO_BE_COMMITED
-        for aLine in result:
-            aLine = str(aLine).strip()
-            if aLine == GitUtil.STATUS_CHANGES_TO_BE_COMMITED_IDENTIFIER:
-                mode = GitUtil.STATUS_CHANGES_TO_BE_COMMITED
-            elif aLine == GitUtil.STATUS_CHANGES_NOT_STAGED_IDENTIFIER:
-                mode = GitUtil.STATUS_CHANGES_NOT_STAGED
-            elif aLine == GitUtil.STATUS_UNTRACKED_IDENTIFIER:
-                mode = GitUtil.STATUS_UNTRACKED
-            elif aLine in GitUtil.STATUS_IGNORE_OTHERS:
-                pass
+    def _get_result_lines(argv, gitPath, enableStrip=True):
+        result = []
+        if os.path.isdir(gitPath):
+            _result = GitUtil.runner.run(argv, gitPath)
+            if _result.ok:
+                result = _result.get_lines(enableStrip)
+        return result
+
+    @staticmethod
+    def _get_prefix(gitPath):
+        # porcelain paths are relative to the top of the work tree
+        if os.path.exists(os.path.join(gitPath, ".git")):
+            return ""
+        result = GitUtil.runner.run(["git", "rev-parse", "--show-prefix"], gitPath)
+        return result.stdout.strip() if result.ok else ""
+
+    @staticmethod
+    def _to_relative_path(prefix, path):
+        if not prefix:
+            return path
+        if path.startswith(prefix):
+            return path[len(prefix):]
+        return os.path.relpath(path, prefix) + ("/" if path.endswith("/") else "")
+
+    @staticmethod
+    def get_status(gitPath, gitOpt=""):
+        result = {"staged": [], "unstaged": [], "untracked": [], "unmerged": [], "deleted": []}
+        if not os.path.isdir(gitPath):
+            return result
+        _result = GitUtil.runner.run(["git", "status", "--porcelain=v2", "-z"] + GitUtil._get_options(gitOpt), gitPath)
+        if not _result.ok:
+            return result
+
+        prefix = GitUtil._get_prefix(gitPath)
+        entries = _result.stdout.split("\0")
+        i = 0
+        while i < len(entries):
+            entry = entries[i]
+            i += 1
+            if not entry:
+                continue
+            entry_type = entry[0]
+            if entry_type == GitUtil.STATUS_ORDINARY:
+                # 1 XY sub mH mI mW hH hI path
+                fields = entry.split(" ", 8)
+            elif entry_type == GitUtil.STATUS_RENAMED:
+                # 2 XY sub mH mI mW hH hI Xscore path\0origPath
+                fields = entry.split(" ", 9)
+                i += 1
+            elif entry_type == GitUtil.STATUS_UNMERGED:
+                # u XY sub m1 m2 m3 mW h1 h2 h3 path
+                fields = entry.split(" ", 10)
+                result["unmerged"].append(GitUtil._to_relative_path(prefix, fields[-1]))
+                continue
+            elif entry_type == GitUtil.STATUS_UNTRACKED:
+                result["untracked"].append(GitUtil._to_relative_path(prefix, entry[2:]))
+                continue
+            else:
+                continue
+
+            index_status, worktree_status = fields[1][0], fields[1][1]
+            path = GitUtil._to_relative_path(prefix, fields[-1])
+            if "D" in [index_status, worktree_status]:
+                result["deleted"].append(path)
             else:
-                if mode in [GitUtil.STATUS_CHANGES_NOT_STAGED, GitUtil.STATUS_CHANGES_TO_BE_COMMITED]:
-                    pos = aLine.find(GitUtil.STATUS_CHANGES_MODIFIED)
-                    if pos == -1:
-                        pos = aLine.find(GitUtil.STATUC_CHANGES_NEWFILE)
-                    if pos != -1:
-                        aFile = aLine[pos + GitUtil.STATUS_CHANGES_MODIFIED_LEN + 1:].strip()
-                        if os.path.exists(aFile):
-                            if mode == GitUtil.STATUS_CHANGES_TO_BE_COMMITED:
-                                result_to_be_commited.append(aFile)
-                            else:
-                                result_changes_not_staged.append(aFile)
-                elif mode == GitUtil.STATUS_UNTRACKED:
-                    if os.path.exists(aLine):
-                        result_untracked.append(aLine)
-
-        all_modified = result_to_be_commited.copy()
-        all_modified.extend(result_changes_not_staged)
-        all_modified.extend(result_untracked)
-        all_modified = list(set(all_modified))
+                if index_status != ".":
+                    result["staged"].append(path)
+                if worktree_status != ".":
+                    result["unstaged"].append(path)
+        return result
+
+    @staticmethod
+    def is_work_tree(gitPath):
+        if os.path.exists(os.path.join(gitPath, ".git")):
+            return True
+        if not os.path.isdir(gitPath):
+            return False
+        result = GitUtil.runner.run(["git", "rev-parse", "--is-inside-work-tree"], gitPath, verbose=False)
+        return result.ok and result.stdout.strip() == "true"
+
+    @staticmethod
+    def _get_ls_files(gitPath, options):
+        # the paths are relative to gitPath
+        result = []
+        if os.path.isdir(gitPath):
+            _result = GitUtil.runner.run(["git", "ls-files", "-z"] + options, gitPath)
+            if _result.ok:
+                result = [path for path in _result.stdout.split("\0") if path]
+        return result
+
+    @staticmethod
+    def get_unmerged(gitPath):
+        # only the index is read. the work tree isn't scanned.
+        result = []
+        for entry in GitUtil._get_ls_files(gitPath, ["-u"]):
+            # mode sha stage\tpath. an unmerged path has the stage 1-3 entries.
+            path = entry.split("\t", 1)[-1]
+            if not result or result[-1] != path:
+                result.append(path)
+        return result
+
+    @staticmethod
+    def get_files(gitPath, untracked=True):
+        # the tracked files and the untracked files which are not ignored by .gitignore
+        return GitUtil._get_ls_files(gitPath, ["-c", "-o", "--exclude-standard"] if untracked else ["-c"])
+
+    @staticmethod
+    def status(gitPath, gitOpt=""):
+        if GitUtil.backend and not gitOpt:
+            result = GitUtil.backend.status(gitPath)
+            if result != None:
+                return result
+
+        status = GitUtil.get_status(gitPath, gitOpt)
+        # the unmerged paths are listed with the changes to be committed for the compatibility
+        result_to_be_commited = status["staged"] + status["unmerged"]
+        result_changes_not_staged = [path for path in status["unstaged"] if not path in status["staged"]]
+        result_untracked = status["untracked"]
 
+        all_modified = list(set(result_to_be_commited + result_changes_not_staged + result_untracked))
         return all_modified, result_to_be_commited, result_changes_not_staged, result_untracked
 
     @staticmethod
     def diff(gitPath, gitOpt=""):
-        exec_cmd = f"git diff {gitOpt if gitOpt else ''}"
-        return ExecUtil.getExecResultEachLine(exec_cmd, gitPath, False, False, True)
\ No newline at end of file
+        options = GitUtil._get_options(gitOpt)
+        if GitUtil.backend:
+            result = GitUtil.backend.diff(gitPath, options)
+            if result != None:
+                return result
+        return GitUtil._get_result_lines(["git", "diff"] + options, gitPath, False)
+
+    @staticmethod
+    def _get_workspace_state(gitPath, paths):
+        # the diff is same while HEAD, index and the files are not changed
+        git_dir = os.path.join(gitPath, ".git")
+        if not os.path.isdir(git_dir):
+            return None
+        targets = [os.path.join(git_dir, name) for name in ["HEAD", "index", "packed-refs"]]
+        try:
+            with open(targets[0], encoding="utf-8") as f:
+                head = f.read().strip()
+            if head.startswith("ref: "):
+                targets.append(os.path.join(git_dir, head[5:]))
+        except OSError:
+            return None
+        targets.extend(os.path.join(gitPath, path) for path in paths)
+        result = []
+        for target in targets:
+            try:
+                stat = os.stat(target)
+                result.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                result.append(None)
+        return tuple(result)
+
+    @staticmethod
+    def diff_files(gitPath, paths, gitOpt=""):
+        # one git diff for all the paths. the result is cached while the workspace state is same,
+        # and the later request for the part of the paths is answered from the cache.
+        options = GitUtil._get_options(gitOpt)
+        paths = list(paths)
+        key = (os.path.abspath(gitPath), tuple(options))
+        with GitUtil._diff_cache_lock:
+            cached = GitUtil._diff_cache.get(key)
+        if cached:
+            cached_paths, cached_state, cached_result = cached
+            if set(paths) <= cached_paths and cached_state and cached_state == GitUtil._get_workspace_state(gitPath, sorted(cached_paths)):
+                return cached_result
+
+        state = GitUtil._get_workspace_state(gitPath, sorted(set(paths)))
+        result = GitDiff(GitUtil.diff(gitPath, options + ["--"] + paths) if paths else [], GitUtil._get_prefix(gitPath))
+        if state:
+            with GitUtil._diff_cache_lock:
+                GitUtil._diff_cache.pop(key, None)
+                while len(GitUtil._diff_cache) >= GitUtil.DIFF_CACHE_SIZE:
+                    GitUtil._diff_cache.pop(next(iter(GitUtil._diff_cache)))
+                GitUtil._diff_cache[key] = (set(paths), state, result)
+        return result
+
+    @staticmethod
+    def read_blob(gitPath, path, rev="HEAD"):
+        if GitUtil.backend:
+            result = GitUtil.backend.read_blob(gitPath, path, rev)
+            if result != None:
+                return result
+        return GitUtil._get_result_lines(["git", "show", f'{rev}:./{path}'], gitPath, False)
+
+
+GitUtil.set_backend(os.getenv("GIT_UTIL_BACKEND", "git"))
\ No newline at end of file
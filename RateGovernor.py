@@ -0,0 +1,97 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import time
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+class RateGovernor:
+    DEFAULT_STATE_DIR = os.path.join(tempfile.gettempdir(), "gerrit-util-governor")
+    SLOT_POLL_INTERVAL = 0.1
+
+    def __init__(self, rate=None, max_sessions=None, state_dir=None, burst=None):
+        # rate: requests/sec shared by all processes using the same state_dir
+        # max_sessions: max concurrent sessions shared by all processes using the same state_dir
+        self.rate = rate
+        self.burst = burst if burst else max(1, rate or 1)
+        self.max_sessions = max_sessions
+        self.state_dir = state_dir if state_dir else RateGovernor.DEFAULT_STATE_DIR
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.bucket_path = os.path.join(self.state_dir, "bucket")
+
+    @staticmethod
+    def from_env():
+        rate = os.getenv("GERRIT_RATE_LIMIT")
+        max_sessions = os.getenv("GERRIT_MAX_SESSIONS")
+        if rate or max_sessions:
+            return RateGovernor(float(rate) if rate else None, int(max_sessions) if max_sessions else None, os.getenv("GERRIT_GOVERNOR_DIR"))
+        return None
+
+    def acquire_token(self):
+        if not self.rate:
+            return
+        while True:
+            wait = 0
+            with open(self.bucket_path, "a+") as f:
+                # the token bucket state is shared via the lock file
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                now = time.time()
+                tokens = self.burst
+                last = now
+                try:
+                    tokens, last = [float(value) for value in f.read().split()]
+                except ValueError:
+                    pass
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    wait = (1 - tokens) / self.rate
+                f.seek(0)
+                f.truncate()
+                f.write(f'{tokens} {now}')
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def acquire_slot(self):
+        if not self.max_sessions:
+            return None
+        while True:
+            for i in range(self.max_sessions):
+                f = open(os.path.join(self.state_dir, f'slot-{i}'), "a")
+                try:
+                    # the lock is released by the kernel even if the process is killed
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return f
+                except OSError:
+                    f.close()
+            time.sleep(RateGovernor.SLOT_POLL_INTERVAL)
+
+    def release_slot(self, slot):
+        if slot:
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            slot.close()
+
+    @contextmanager
+    def session(self):
+        self.acquire_token()
+        slot = self.acquire_slot()
+        try:
+            yield
+        finally:
+            self.release_slot(slot)
@@ -0,0 +1,78 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import re
+from GerritUtil import GerritUtil
+
+class RepoUtil:
+    REPO_DOWNLOAD_PATTERN = re.compile(r'^repo download (\S+) (\d+)/(\d+)$')
+    PATCHSET_PATTERN = re.compile(r'refs/changes/\d+/\d+/(\d+)')
+
+    @staticmethod
+    def is_repo_workspace(repo_dir):
+        return os.path.isdir(os.path.join(repo_dir, ".repo"))
+
+    @staticmethod
+    def get_project_paths(repo_dir):
+        # project name -> path in the workspace
+        result = {}
+        for line in GerritUtil.runner.run(["repo", "list"], repo_dir, verbose=False).get_lines():
+            pos = line.find(" : ")
+            if pos != -1:
+                result[line[pos+3:].strip()] = line[:pos].strip()
+        return result
+
+    @staticmethod
+    def parse_repo_download_cmd(repo_download_cmd):
+        # repo download project number/patchset
+        m = RepoUtil.REPO_DOWNLOAD_PATTERN.match(repo_download_cmd.strip())
+        return (m.group(1), m.group(2), m.group(3)) if m else (None, None, None)
+
+    @staticmethod
+    def get_patchset(download_cmd, default="1"):
+        m = RepoUtil.PATCHSET_PATTERN.search(download_cmd) if download_cmd else None
+        return m.group(1) if m else default
+
+    @staticmethod
+    def _get_manifest_revision(project_dir):
+        # repo sync points refs/remotes/m/<manifest branch> to the revision in the manifest
+        result = GerritUtil.runner.run(["git", "for-each-ref", "--format=%(objectname)", "refs/remotes/m/"], project_dir, verbose=False)
+        lines = result.get_lines() if result.ok else []
+        return lines[0] if lines else None
+
+    @staticmethod
+    def download(repo_dir, project_path, project, number, patchset="1"):
+        project_dir = os.path.join(repo_dir, project_path)
+
+        # discard the previous change of the project
+        for command in ["rebase", "merge", "cherry-pick"]:
+            GerritUtil.runner.run(["git", command, "--abort"], project_dir, verbose=False)
+        base = RepoUtil._get_manifest_revision(project_dir)
+        if base:
+            GerritUtil.runner.run(["git", "checkout", "-f", "--detach", base], project_dir, verbose=False)
+            GerritUtil.runner.run(["git", "clean", "-fd"], project_dir, verbose=False)
+
+        with GerritUtil.session():
+            result = GerritUtil.runner.run(["repo", "download", project, f'{number}/{patchset}'], repo_dir)
+        if not result.ok:
+            raise RuntimeError(f'repo download {project} {number}/{patchset} failed')
+
+        if base:
+            # same as git clone -b branch; git pull ref --rebase
+            patchset_sha = GerritUtil.runner.run(["git", "rev-parse", "HEAD"], project_dir, verbose=False).stdout.strip()
+            GerritUtil.runner.run(["git", "checkout", "-f", "-B", f'gerrit-util/{number}', base], project_dir)
+            GerritUtil.runner.run(["git", "rebase", patchset_sha], project_dir)
+
+        return project_dir
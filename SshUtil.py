@@ -0,0 +1,79 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import atexit
+import shutil
+import subprocess
+import tempfile
+
+class SshUtil:
+    GIT_SSH_COMMAND = "GIT_SSH_COMMAND"
+    # the master started by ssh or git itself (e.g. the up-front master failed) exits after idle seconds
+    CONTROL_PERSIST = 60
+
+    control_dir = None
+    hosts = []
+    _original_git_ssh_command = None
+
+    @staticmethod
+    def get_ssh_options():
+        result = []
+        if SshUtil.control_dir:
+            # %C is hash of the connection so that the socket path is short enough
+            result = [
+                "-o", "ControlMaster=auto",
+                "-o", f'ControlPath={os.path.join(SshUtil.control_dir, "%C")}',
+                "-o", f'ControlPersist={SshUtil.CONTROL_PERSIST}'
+            ]
+        return result
+
+    @staticmethod
+    def get_ssh_command():
+        return ["ssh"] + SshUtil.get_ssh_options()
+
+    @staticmethod
+    def start_multiplexer(hosts):
+        if not SshUtil.control_dir:
+            SshUtil.control_dir = tempfile.mkdtemp(prefix="gerrit-util-ssh-")
+            SshUtil._original_git_ssh_command = os.environ.get(SshUtil.GIT_SSH_COMMAND)
+            # git clone/pull/push over ssh:// go through the same master
+            git_ssh_command = SshUtil._original_git_ssh_command if SshUtil._original_git_ssh_command else "ssh"
+            os.environ[SshUtil.GIT_SSH_COMMAND] = " ".join([git_ssh_command] + SshUtil.get_ssh_options())
+            atexit.register(SshUtil.stop_multiplexer)
+
+        for host in hosts:
+            if host and not host in SshUtil.hosts:
+                # the up-front master lives until stop_multiplexer even if idle while the LLM is running.
+                # ssh uses the first value of the option, so this overrides CONTROL_PERSIST.
+                result = subprocess.run(["ssh", "-o", "ControlPersist=yes"] + SshUtil.get_ssh_options() + ["-M", "-N", "-f", host], stdin=subprocess.DEVNULL, capture_output=True, text=True)
+                if result.returncode == 0:
+                    SshUtil.hosts.append(host)
+                else:
+                    print(f"Failed to start ssh control master for {host}: {result.stderr.strip()}")
+
+    @staticmethod
+    def stop_multiplexer():
+        if SshUtil.control_dir:
+            # exit all the masters including the ones not started by start_multiplexer
+            for socket in os.listdir(SshUtil.control_dir):
+                subprocess.run(["ssh", "-S", os.path.join(SshUtil.control_dir, socket), "-O", "exit", "gerrit-util"], stdin=subprocess.DEVNULL, capture_output=True)
+            SshUtil.hosts = []
+
+            if SshUtil._original_git_ssh_command == None:
+                os.environ.pop(SshUtil.GIT_SSH_COMMAND, None)
+            else:
+                os.environ[SshUtil.GIT_SSH_COMMAND] = SshUtil._original_git_ssh_command
+            shutil.rmtree(SshUtil.control_dir, ignore_errors=True)
+            SshUtil.control_dir = None
@@ -0,0 +1,118 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import json
+import time
+import fcntl
+import shutil
+from contextlib import contextmanager
+
+class WorkspaceCache:
+    INDEX_FILE = ".workspace-index.json"
+    LOCK_DIR = ".workspace-locks"
+    SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+    def __init__(self, base_dir, quota):
+        self.base_dir = base_dir
+        self.quota = WorkspaceCache.parse_size(quota)
+        self.lock_dir = os.path.join(base_dir, WorkspaceCache.LOCK_DIR)
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.index_path = os.path.join(base_dir, WorkspaceCache.INDEX_FILE)
+
+    @staticmethod
+    def parse_size(size):
+        # e.g. 100G
+        if isinstance(size, str):
+            size = size.strip().upper().rstrip("B")
+            if size and size[-1] in WorkspaceCache.SIZE_UNITS:
+                return int(float(size[:-1]) * WorkspaceCache.SIZE_UNITS[size[-1]])
+            return int(size)
+        return size
+
+    @staticmethod
+    def get_size(path):
+        result = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    # actual disk usage rather than the file size
+                    result += os.lstat(os.path.join(dirpath, filename)).st_blocks * 512
+                except OSError:
+                    pass
+        return result
+
+    @contextmanager
+    def _index(self):
+        # the index is shared among the processes using the same base_dir
+        with open(self.index_path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = {}
+            try:
+                with open(self.index_path, encoding="utf-8") as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                pass
+            yield index
+            with open(self.index_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(index, f)
+            os.replace(self.index_path + ".tmp", self.index_path)
+
+    def _get_lock_path(self, id):
+        return os.path.join(self.lock_dir, f'{id}.lock')
+
+    def acquire(self, id):
+        # shared lock while the workspace is in use. the eviction needs the exclusive lock.
+        lock = open(self._get_lock_path(id), "a")
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        return lock
+
+    def release(self, lock):
+        if lock:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def update(self, id):
+        # walk the workspace. call only after the download changed it.
+        size = WorkspaceCache.get_size(os.path.join(self.base_dir, str(id)))
+        with self._index() as index:
+            index[str(id)] = {"size": size, "last_used": time.time()}
+
+    def touch(self, id):
+        # update only the last use. the size is measured by update.
+        with self._index() as index:
+            if str(id) in index:
+                index[str(id)]["last_used"] = time.time()
+                return
+        self.update(id)
+
+    def evict(self):
+        evicted = []
+        with self._index() as index:
+            total = sum(entry["size"] for entry in index.values())
+            for id, entry in sorted(index.items(), key=lambda item: item[1]["last_used"]):
+                if total <= self.quota:
+                    break
+                with open(self._get_lock_path(id), "a") as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        # another process or thread is using the workspace
+                        continue
+                    shutil.rmtree(os.path.join(self.base_dir, id), ignore_errors=True)
+                    total -= entry["size"]
+                    evicted.append(id)
+            for id in evicted:
+                del index[id]
+        return evicted
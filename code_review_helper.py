@@ -40,8 +40,10 @@ checker = []
 if LlmReview.isAvailable():
     checker.append(LlmReview())
 
+# one git diff for all the modified files
+diffs = GitUtil.diff_files(".", all_modified, "HEAD")
 for aFile in all_modified:
-    result = GitUtil.diff(".", f"HEAD {aFile}")
+    result = diffs.get_lines(aFile)
     if result or aFile in result_to_be_commited:
         # actual modified file!
         print(aFile)
@@ -16,6 +16,8 @@ import os
 import re
 import argparse
 from GerritUtil import GerritUtil
+from GerritDownloader import GerritDownloader
+from SshUtil import SshUtil
 from GitUtil import GitUtil
 from FileUtil import FileUtil
 
@@ -84,14 +86,27 @@ def main():
     parser.add_argument('-n', '--numbers', default="", action='store', help='Specify gerrit numbers with ,')
     parser.add_argument('--gitpath', default=None, action='store', help='Specify regexp for project(gitpath) if necessary')
 
-    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http')
+    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http or rest (query via Gerrit REST API)')
+    parser.add_argument('--sshmux', default=False, action='store_true', help='Specify if share one ssh connection (ControlMaster) for gerrit and git access')
 
     parser.add_argument('-d', '--download', default='.', help='Specify download path')
     parser.add_argument('-r', '--renew', default=False, action='store_true', help='Specify if re-download anyway')
+    parser.add_argument('--mirror', default=None, action='store', help='Specify bare mirror directory shared among the downloads')
+    parser.add_argument('--repo', default=None, action='store', help='Specify existing repo workspace (which has .repo) to download the changes with repo download into the project directories')
+    parser.add_argument('--sparse', default=False, action='store_true', help='Specify if check out only the changed files and the commented files with partial clone')
+    parser.add_argument('--depth', default=0, type=int, action='store', help='Specify history depth of partial clone (0: full history)')
+    parser.add_argument('--workers', default=GerritDownloader.DEFAULT_WORKERS, type=int, action='store', help='Specify number of parallel downloads')
+    parser.add_argument('--hostworkers', default=GerritDownloader.DEFAULT_HOST_WORKERS, type=int, action='store', help='Specify max parallel downloads per git host')
+    parser.add_argument('--quota', default=None, action='store', help='Specify disk quota of the download path e.g. 100G. The least recently used workspaces are removed if exceeded')
     parser.add_argument('-m', '--marginline', default=10, type=int, action='store', help='Specify margin lines')
     args = parser.parse_args()
 
+    if args.sshmux:
+        SshUtil.start_multiplexer([args.target])
+
     result = GerritUtil.query(args.target, args.branch, args.status, args.since, args.numbers.split(","), ["--comments", "--current-patch-set"], args.connection, args.gitpath)
+    downloader = GerritDownloader.new_downloader(args, "current_patchset_ssh")
+    downloader.prefetch((project, branch, _data) for project, branch, _data in GerritUtil.ungroup_results(result) if _data["comments"])
 
     for project, data in result.items():
         for branch, theData in data.items():
@@ -102,7 +117,9 @@ def main():
                     print(f'{key}:{value}')
                 print("")
                 if "number" in _data and "current_patchset_ssh" in _data and _data["comments"]:
-                    download_path = GerritUtil.download(args.download, _data["number"], _data["current_patchset_ssh"], args.renew)
+                    download_path = downloader.get(_data)
+                    if not download_path:
+                        continue
                     comment_extractor = CommentExtractor(download_path, _data["comments"], args.marginline)
                     comment_sections = comment_extractor.get_comments()
                     for file_name, comments in comment_sections.items():
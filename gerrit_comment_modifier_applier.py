@@ -15,6 +15,9 @@
 import os
 import argparse
 from GerritUtil import GerritUtil
+from GerritDownloader import GerritDownloader
+from GerritUploader import GerritUploader
+from SshUtil import SshUtil
 from GitUtil import GitUtil
 from FileUtil import FileUtil
 from GptHelper import GptClientFactory, IGpt, GptQueryWithCheck
@@ -225,6 +228,47 @@ class ResolutionApplier:
         return resolutions
 
 
+def modify_change(args, modifier, applier, downloader, uploader, project, branch, _data):
+    print(f'project:{project}')
+    print(f'branch:{branch}')
+    for key, value in _data.items():
+        print(f'{key}:{value}')
+    print("")
+    if "number" in _data and "current_patchset_ssh" in _data and _data["comments"]:
+        download_path = downloader.get(_data)
+        if not download_path:
+            return False
+        comment_extractor = CommentExtractor(download_path, _data["comments"], args.marginline)
+        comment_sections = comment_extractor.get_comments()
+        modified_files = []
+
+        for file_name, comments in comment_sections.items():
+            print(file_name)
+            resolutions = []
+            file_full_path = os.path.join(download_path,file_name)
+            target_file_lines = FileUtil.read_file(file_full_path)
+            for i,comment in enumerate(comments):
+                print(f'absolute_pos={comment["line_number"]}:comment={comment["message"]}:the_line={comment["target_line"]}\nrelative_pos={comment["relative_pos"]}')
+
+                result, response = modifier.query(comment["section_lines"], comment["message"], comment["relative_pos"])
+                print(result)
+
+                resolutions = applier.add_to_resolutions(target_file_lines, comment["start_pos"], comment["end_pos"], result, resolutions)
+
+            target_file_lines = applier.apply(target_file_lines, resolutions)
+            print("applied filed:")
+            print("\n".join(target_file_lines))
+
+            if args.apply:
+                FileUtil.save_modified_code(file_full_path, target_file_lines)
+                modified_files.append(file_full_path)
+
+        if args.upload:
+            return uploader.add(download_path, branch, _data["number"], modified_files)
+
+    return False
+
+
 def main():
     parser = argparse.ArgumentParser(description='Gerrit comment AI helper')
     parser.add_argument('-t', '--target', default=os.getenv("GERRIT_HOST", 'gerrit-ssh'), help='Specify ssh target host')
@@ -234,10 +278,18 @@ def main():
     parser.add_argument('-n', '--numbers', default="", action='store', help='Specify gerrit numbers with ,')
     parser.add_argument('--gitpath', default=None, action='store', help='Specify regexp for project(gitpath) if necessary')
 
-    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http')
+    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http or rest (query via Gerrit REST API)')
+    parser.add_argument('--sshmux', default=False, action='store_true', help='Specify if share one ssh connection (ControlMaster) for gerrit and git access')
 
     parser.add_argument('-w', '--download', default='.', help='Specify download path')
     parser.add_argument('-r', '--renew', default=False, action='store_true', help='Specify if re-download anyway')
+    parser.add_argument('--mirror', default=None, action='store', help='Specify bare mirror directory shared among the downloads')
+    parser.add_argument('--repo', default=None, action='store', help='Specify existing repo workspace (which has .repo) to download the changes with repo download into the project directories')
+    parser.add_argument('--sparse', default=False, action='store_true', help='Specify if check out only the changed files and the commented files with partial clone')
+    parser.add_argument('--depth', default=0, type=int, action='store', help='Specify history depth of partial clone (0: full history)')
+    parser.add_argument('--workers', default=GerritDownloader.DEFAULT_WORKERS, type=int, action='store', help='Specify number of parallel downloads')
+    parser.add_argument('--hostworkers', default=GerritDownloader.DEFAULT_HOST_WORKERS, type=int, action='store', help='Specify max parallel downloads per git host')
+    parser.add_argument('--quota', default=None, action='store', help='Specify disk quota of the download path e.g. 100G. The least recently used workspaces are removed if exceeded')
     parser.add_argument('-m', '--marginline', default=10, type=int, action='store', help='Specify margin lines')
 
     parser.add_argument('-c', '--useclaude', action='store_true', default=False, help='specify if you want to use calude3')
@@ -252,50 +304,29 @@ def main():
 
     parser.add_argument('-a', '--apply', action='store_true', default=False, help='Specify if apply the modification for the conflicted file')
     parser.add_argument('-u', '--upload', action='store_true', default=False, help='Specify if upload the the conflict resolved result')
+    parser.add_argument('--label', action='append', default=[], help='Specify label to vote on the uploaded patchset e.g. Code-Review=+1 (multiple --label are ok)')
+    parser.add_argument('--message', action='store', default=None, help='Specify review message to post on the uploaded patchset')
+    parser.add_argument('--uploadbatch', default=GerritUploader.DEFAULT_BATCH_SIZE, type=int, action='store', help='Specify number of amended changes to keep before pushing them one by one and posting --label/--message in one gerrit review (1: push each change immediately)')
 
     args = parser.parse_args()
 
+    if args.sshmux:
+        SshUtil.start_multiplexer([args.target])
+
     result = GerritUtil.query(args.target, args.branch, args.status, args.since, args.numbers.split(","), ["--comments", "--current-patch-set"], args.connection, args.gitpath)
+    downloader = GerritDownloader.new_downloader(args, "current_patchset_ssh")
+    downloader.prefetch((project, branch, _data) for project, branch, _data in GerritUtil.ungroup_results(result) if _data["comments"])
 
     gpt_client = GptClientFactory.new_client(args)
     modifier = ModifierWithLLM(gpt_client, args.promptfile)
     applier = ResolutionApplier(args.marginline)
+    uploader = GerritUploader.new_uploader(args, downloader)
 
     for project, data in result.items():
         for branch, theData in data.items():
             for _data in theData:
-                print(f'project:{project}')
-                print(f'branch:{branch}')
-                for key, value in _data.items():
-                    print(f'{key}:{value}')
-                print("")
-                if "number" in _data and "current_patchset_ssh" in _data and _data["comments"]:
-                    download_path = GerritUtil.download(args.download, _data["number"], _data["current_patchset_ssh"], args.renew)
-                    comment_extractor = CommentExtractor(download_path, _data["comments"], args.marginline)
-                    comment_sections = comment_extractor.get_comments()
-
-                    for file_name, comments in comment_sections.items():
-                        print(file_name)
-                        resolutions = []
-                        file_full_path = os.path.join(download_path,file_name)
-                        target_file_lines = FileUtil.read_file(file_full_path)
-                        for i,comment in enumerate(comments):
-                            print(f'absolute_pos={comment["line_number"]}:comment={comment["message"]}:the_line={comment["target_line"]}\nrelative_pos={comment["relative_pos"]}')
-
-                            result, response = modifier.query(comment["section_lines"], comment["message"], comment["relative_pos"])
-                            print(result)
-
-                            resolutions = applier.add_to_resolutions(target_file_lines, comment["start_pos"], comment["end_pos"], result, resolutions)
-
-                        target_file_lines = applier.apply(target_file_lines, resolutions)
-                        print("applied filed:")
-                        print("\n".join(target_file_lines))
-
-                        if args.apply:
-                            FileUtil.save_modified_code(file_full_path, target_file_lines)
-
-                    if args.upload:
-                        GerritUtil.upload(download_path, branch)
+                modify_change(args, modifier, applier, downloader, uploader, project, branch, _data)
+    uploader.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+#   Copyright 2024 hidenorly
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import argparse
+import os
+import re
+import time
+
+from GerritUtil import GerritUtil
+from GerritDownloader import GerritDownloader
+from GerritUploader import GerritUploader
+from SshUtil import SshUtil
+from GptHelper import GptClientFactory
+from gerrit_merge_conflict_solver import MergeConflictSolver
+from gerrit_merge_conflict_resolution_applier import MergeConflictResolutionApplier
+from gerrit_merge_conflict_resolution_applier_with_upload import UploadableChecker, resolve_change
+from gerrit_comment_modifier import ModifierWithLLM
+from gerrit_comment_modifier_applier import ResolutionApplier, modify_change
+
+
+class GerritEventDaemon:
+    EVENT_PATCHSET_CREATED = "patchset-created"
+    EVENT_COMMENT_ADDED = "comment-added"
+
+    def __init__(self, args, conflict_pipeline=None, comment_pipeline=None, uploader=None):
+        self.args = args
+        self.uploader = uploader
+        self.filter_git = re.compile(args.gitpath) if args.gitpath else None
+        self.pipelines = {}
+        if conflict_pipeline:
+            self.pipelines[GerritEventDaemon.EVENT_PATCHSET_CREATED] = conflict_pipeline
+        if comment_pipeline:
+            self.pipelines[GerritEventDaemon.EVENT_COMMENT_ADDED] = comment_pipeline
+        self.self_uploaded = set()
+        if uploader:
+            # only the pushed changes. the amended but failed ones should be resolved again on the next patchset.
+            uploader.on_uploaded = self._on_uploaded
+
+    def _on_uploaded(self, changes):
+        for number, _sha in changes:
+            self.self_uploaded.add(number)
+
+    def is_target_event(self, event):
+        change = event.get("change", {})
+        project = change.get("project")
+        if not event.get("type") in self.pipelines or not project:
+            return False
+        if change.get("branch") != self.args.branch:
+            return False
+        if self.filter_git and not self.filter_git.match(project):
+            return False
+        return True
+
+    def handle_event(self, event):
+        event_type = event["type"]
+        number = str(event["change"]["number"])
+        if event_type == GerritEventDaemon.EVENT_PATCHSET_CREATED and number in self.self_uploaded:
+            # the patchset uploaded by ourself. don't resolve it again.
+            self.self_uploaded.discard(number)
+            return
+
+        # the pipelines work on the current patchset, not the patchset1
+        extra_commands = ["--comments", "--current-patch-set"] if event_type == GerritEventDaemon.EVENT_COMMENT_ADDED else ["--current-patch-set"]
+        if self.args.sparse and event_type == GerritEventDaemon.EVENT_PATCHSET_CREATED:
+            extra_commands = ["--files", "--current-patch-set"]
+        for project, branch, _data in GerritUtil.iter_query(self.args.target, self.args.branch, "open", "1 day ago", [number], extra_commands, self.args.connection):
+            self.pipelines[event_type](project, branch, _data)
+        if self.uploader:
+            # don't keep the resolved change until the next event
+            self.uploader.flush()
+
+    def run(self):
+        event_types = list(self.pipelines.keys())
+        while True:
+            for event in GerritUtil.stream_events(self.args.target, event_types):
+                if self.is_target_event(event):
+                    print(f'{event["type"]}:{event["change"]["project"]}:{event["change"]["number"]}')
+                    try:
+                        self.handle_event(event)
+                    except Exception as e:
+                        print(f'Failed to handle {event["change"]["number"]}: {e}')
+            # the stream is disconnected. reconnect after a while.
+            print(f"stream-events is disconnected. Retry after {self.args.retry} sec")
+            time.sleep(self.args.retry)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run merge conflict solver and comment modifier on gerrit stream-events')
+    parser.add_argument('-t', '--target', default=os.getenv("GERRIT_HOST", 'gerrit-ssh'), help='Specify ssh target host')
+    parser.add_argument('-b', '--branch', default=os.getenv("GERRIT_BRANCH", 'main'), help='Branch to watch')
+    parser.add_argument('--gitpath', default=None, action='store', help='Specify regexp for project(gitpath) if necessary')
+    parser.add_argument('--events', default="conflict,comment", action='store', help='Specify pipelines to run with , (conflict: on patchset-created, comment: on comment-added)')
+    parser.add_argument('--retry', default=10, type=int, action='store', help='Specify seconds to wait before reconnecting stream-events')
+
+    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http or rest (query via Gerrit REST API)')
+    parser.add_argument('--sshmux', default=False, action='store_true', help='Specify if share one ssh connection (ControlMaster) for gerrit and git access')
+
+    parser.add_argument('-w', '--download', default='.', help='Specify download path')
+    parser.add_argument('-r', '--renew', default=False, action='store_true', help='Specify if re-download anyway')
+    parser.add_argument('--mirror', default=None, action='store', help='Specify bare mirror directory shared among the downloads')
+    parser.add_argument('--repo', default=None, action='store', help='Specify existing repo workspace (which has .repo) to download the changes with repo download into the project directories')
+    parser.add_argument('--sparse', default=False, action='store_true', help='Specify if check out only the changed files and the commented files with partial clone')
+    parser.add_argument('--depth', default=0, type=int, action='store', help='Specify history depth of partial clone (0: full history)')
+    parser.add_argument('--workers', default=GerritDownloader.DEFAULT_WORKERS, type=int, action='store', help='Specify number of parallel downloads')
+    parser.add_argument('--hostworkers', default=GerritDownloader.DEFAULT_HOST_WORKERS, type=int, action='store', help='Specify max parallel downloads per git host')
+    parser.add_argument('--quota', default=None, action='store', help='Specify disk quota of the download path e.g. 100G. The least recently used workspaces are removed if exceeded')
+    parser.add_argument('-m', '--marginline', default=10, type=int, action='store', help='Specify margin lines')
+    parser.add_argument('-l', '--largerconflictsection', default=False, action='store_true', help='Specify if unify overwrapped sections')
+    parser.add_argument('--fullscan', default=False, action='store_true', help='Specify if scan all the files (except .gitignore-d and binary) for conflict markers instead of the unmerged files')
+
+    parser.add_argument('-c', '--useclaude', action='store_true', default=False, help='specify if you want to use calude3 (force to use claude3 for option backward compatibiliy)')
+    parser.add_argument('-g', '--gpt', action='store', default="openai", help='specify openai or calude3 or openaicompatible')
+    parser.add_argument('-k', '--apikey', action='store', default=None, help='specify your API key or set it in AZURE_OPENAI_API_KEY env')
+    parser.add_argument('-y', '--secretkey', action='store', default=None, help='specify your secret key or set it in AWS_SECRET_ACCESS_KEY env (for claude3)')
+    parser.add_argument('-e', '--endpoint', action='store', default=None, help='specify your end point or set it in AZURE_OPENAI_ENDPOINT env')
+    parser.add_argument('-d', '--deployment', action='store', default=None, help='specify deployment name or set it in AZURE_OPENAI_DEPLOYMENT_NAME env')
+    parser.add_argument('-H', '--header', action='append', default=[], help='Specify headers for http e.g. header_key:value (multiple --header are ok)')
+
+    parser.add_argument('-p', '--promptfile', action='store', default="./git_merge_conflict_resolution_for_upstream_integration.json", help='specify prompt.json for merge conflict')
+    parser.add_argument('--commentpromptfile', action='store', default=ModifierWithLLM.PROMPT_FILE, help='specify prompt.json for comment modifier')
+
+    parser.add_argument('-a', '--apply', action='store_true', default=False, help='Specify if apply the modification for the conflicted file')
+    parser.add_argument('-u', '--upload', action='store_true', default=False, help='Specify if upload the the conflict resolved result')
+    parser.add_argument('--label', action='append', default=[], help='Specify label to vote on the uploaded patchset e.g. Code-Review=+1 (multiple --label are ok)')
+    parser.add_argument('--message', action='store', default=None, help='Specify review message to post on the uploaded patchset')
+    parser.add_argument('--uploadbatch', default=GerritUploader.DEFAULT_BATCH_SIZE, type=int, action='store', help='Specify number of amended changes to keep before pushing them one by one and posting --label/--message in one gerrit review. Pending changes are pushed after each event anyway (1: push each change immediately)')
+
+    args = parser.parse_args()
+
+    if args.sshmux:
+        SshUtil.start_multiplexer([args.target])
+
+    pipelines = args.events.split(",")
+    uploader = GerritUploader.new_uploader(args)
+    gpt_client = GptClientFactory.new_client(args)
+
+    conflict_pipeline = None
+    if "conflict" in pipelines:
+        solver = MergeConflictSolver(gpt_client, args.promptfile)
+        conflict_applier = MergeConflictResolutionApplier(args.marginline)
+        _useclaude = args.useclaude
+        args.useclaude=True if not args.apikey and not args.endpoint and not args.deployment else False
+        checker = UploadableChecker( GptClientFactory.new_client(args) )
+        args.useclaude = _useclaude
+        # the event can be a later patchset uploaded by human. resolve it instead of the patchset1.
+        conflict_downloader = GerritDownloader.new_downloader(args, "current_patchset_ssh")
+        conflict_pipeline = lambda project, branch, _data: resolve_change(args, solver, conflict_applier, checker, conflict_downloader, uploader, project, branch, _data)
+
+    comment_pipeline = None
+    if "comment" in pipelines:
+        modifier = ModifierWithLLM(gpt_client, args.commentpromptfile)
+        comment_applier = ResolutionApplier(args.marginline)
+        comment_downloader = GerritDownloader.new_downloader(args, "current_patchset_ssh")
+        comment_pipeline = lambda project, branch, _data: modify_change(args, modifier, comment_applier, comment_downloader, uploader, project, branch, _data)
+
+    daemon = GerritEventDaemon(args, conflict_pipeline, comment_pipeline, uploader)
+    daemon.run()
+
+
+if __name__ == "__main__":
+    main()
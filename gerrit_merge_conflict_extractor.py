@@ -16,55 +16,50 @@ import os
 import re
 import argparse
 from GerritUtil import GerritUtil
+from GerritDownloader import GerritDownloader
+from SshUtil import SshUtil
 from GitUtil import GitUtil
+from ConflictScanner import ConflictScanner
 
 class ConflictExtractor:
-    def __init__(self, path, margin_line_count=10, merge_overwrapped_conflict_section=True):
+    STATE_OURS = "ours"
+    STATE_BASE = "base"
+    STATE_THEIRS = "theirs"
+    STATE_MARGIN = "margin"
+
+    def __init__(self, path, margin_line_count=10, merge_overwrapped_conflict_section=True, full_scan=False, scan_workers=None, include_non_utf8=False):
         self.path = path
+        # the non UTF-8 file is decoded with the replacement character. don't return it to the callers which write it back.
+        self.include_non_utf8 = include_non_utf8
+        self.full_scan = full_scan
+        self.scan_workers = scan_workers
         self.margin_line_count = margin_line_count
         self.merge_overwrapped_conflict_section = merge_overwrapped_conflict_section
         self.conflict_start_pattern = re.compile(r'^<{7}')
         self.conflict_end_pattern = re.compile(r'^>{7}')
-
-    def _find_margin_without_another_conflict_section_forward(self, lines, i):
-        target = max(0, i - self.margin_line_count)
-        while i>target:
-            if self.conflict_end_pattern.search(lines[i]):
-                return i+1
-            i -= 1
-        return i
-
-    def _find_margin_without_another_conflict_section_backward(self, lines, i, line_counts):
-        target = min(line_counts, i + self.margin_line_count + 1)
-        while i<target:
-            if self.conflict_start_pattern.search(lines[i]):
-                return i-1
-            i += 1
-        return i
-
-    def _find_conflict_end(self, lines, start, line_counts):
-        for i in range(start + 1, line_counts):
-            if self.conflict_end_pattern.search(lines[i]):
-                return i
-        return None
-
-    def _merge_sections(self, conflict_section_pos):
-        merged_conflict_section_pos = []
-        sorted_conflict_section_pos = sorted(conflict_section_pos, key=lambda x: x[0])
-        if len(sorted_conflict_section_pos)>=2:
-            merged_conflict_section_pos.append(sorted_conflict_section_pos[0])
-            
-            for pos in sorted_conflict_section_pos[1:]:
-                if pos[0] <= merged_conflict_section_pos[-1][1]:
-                    merged_conflict_section_pos[-1][1] = max(pos[1], merged_conflict_section_pos[-1][1])
-                    merged_conflict_section_pos[-1][2] = min(pos[2], merged_conflict_section_pos[-1][2]) # orig_start
-                    merged_conflict_section_pos[-1][3] = max(pos[3], merged_conflict_section_pos[-1][3]) # orig_end
-                else:
-                    merged_conflict_section_pos.append(pos)
+        self.conflict_base_pattern = re.compile(r'^\|{7}(\s|$)')
+        self.conflict_separator_pattern = re.compile(r'^={7}(\s|$)')
+
+    def _add_section(self, sections, conflict, end):
+        # ours, base and theirs are [start, end) without the markers
+        orig_start = conflict["orig_start"]
+        orig_end = conflict["orig_end"]
+        base = conflict["base"]
+        separator = conflict["separator"]
+        ours_end = base if base != None else separator if separator != None else orig_end
+        detail = {
+            "ours": [orig_start + 1, ours_end],
+            "base": [base + 1, separator if separator != None else orig_end] if base != None else None,
+            "theirs": [separator + 1, orig_end] if separator != None else None,
+        }
+        if self.merge_overwrapped_conflict_section and sections and conflict["start"] <= sections[-1]["end"]:
+            # the sections are found in order. merge with the last one if the margins are overwrapped.
+            last = sections[-1]
+            last["end"] = max(end, last["end"])
+            last["orig_end"] = max(orig_end, last["orig_end"])
+            last["conflicts"].append(detail)
         else:
-            merged_conflict_section_pos = sorted_conflict_section_pos
-        
-        return merged_conflict_section_pos
+            sections.append({"start": conflict["start"], "end": end, "orig_start": orig_start, "orig_end": orig_end, "conflicts": [detail]})
 
     def _extract_conflicts(self, file_path):
         lines = []
@@ -74,51 +69,101 @@ class ConflictExtractor:
                     lines = f.readlines()
             except UnicodeDecodeError:
                 pass
+        return self._extract_conflicts_from_lines(lines)
 
-        conflicts = []
-        i = 0
+    def _extract_conflicts_from_lines(self, lines, line_offset=0):
+        # line_offset: the line number of lines[0] in the file
+        # one pass over the lines. <<<<<<< ours ||||||| base ======= theirs >>>>>>> and the margin after it
+        sections = []
         line_counts = len(lines)
-        conflict_section_pos = []
-        _original_conflict_start = None
-        _original_conflict_end = None
-        while i < line_counts:
-            if self.conflict_start_pattern.search(lines[i]):
-                if not _original_conflict_start:
-                    _original_conflict_start = i
-                conflict_start = self._find_margin_without_another_conflict_section_forward(lines, i)
-                conflict_end = self._find_conflict_end(lines, i, line_counts)
-                if not _original_conflict_end:
-                    _original_conflict_end = conflict_end
-                if conflict_end is not None:
-                    conflict_end = self._find_margin_without_another_conflict_section_backward(lines, conflict_end, line_counts)
-                    # conflict_start(0) / conflict_end(1) : including margin line
-                    # _original_conflict_start(2) / _original_conflict_end(3) :  from <<<<<<< ~ >>>>>>>
-                    conflict_section_pos.append([conflict_start, conflict_end, _original_conflict_start, _original_conflict_end])
-                    _original_conflict_start = None
-                    _original_conflict_end = None
-                    i = conflict_end
+        last_end_marker = None
+        state = None
+        conflict = None
+        for i in range(line_counts + 1):
+            line = lines[i] if i < line_counts else None
+            if state == ConflictExtractor.STATE_MARGIN:
+                # the margin ends at the margin lines or before the next conflict
+                margin_end = conflict["orig_end"] + self.margin_line_count + 1
+                if line == None or i >= margin_end:
+                    self._add_section(sections, conflict, min(line_counts, margin_end))
+                    state = None
+                elif self.conflict_start_pattern.search(line):
+                    self._add_section(sections, conflict, i - 1)
+                    state = None
                 else:
-                    i += 1
-            else:
-                i += 1
+                    if self.conflict_end_pattern.search(line):
+                        last_end_marker = i
+                    continue
+            if line == None:
+                break
+
+            if state == None:
+                if self.conflict_start_pattern.search(line):
+                    # the margin before <<<<<<< doesn't include the previous conflict
+                    margin_start = max(0, i - self.margin_line_count)
+                    conflict_start = last_end_marker + 1 if last_end_marker != None and last_end_marker > margin_start else margin_start
+                    conflict = {"start": conflict_start, "orig_start": i, "orig_end": None, "base": None, "separator": None}
+                    state = ConflictExtractor.STATE_OURS
+                elif self.conflict_end_pattern.search(line):
+                    last_end_marker = i
+            elif self.conflict_end_pattern.search(line):
+                conflict["orig_end"] = i
+                last_end_marker = i
+                state = ConflictExtractor.STATE_MARGIN
+            elif state == ConflictExtractor.STATE_OURS and self.conflict_base_pattern.search(line):
+                # diff3 or zdiff3 style
+                conflict["base"] = i
+                state = ConflictExtractor.STATE_BASE
+            elif state != ConflictExtractor.STATE_THEIRS and self.conflict_separator_pattern.search(line):
+                conflict["separator"] = i
+                state = ConflictExtractor.STATE_THEIRS
+
+        # conflict_start(start) / conflict_end(end) : including margin line
+        # orig_start / orig_end :  from <<<<<<< ~ >>>>>>>
+        conflicts = []
+        for section in sections:
+            for detail in section["conflicts"]:
+                for key, pos in detail.items():
+                    if pos:
+                        detail[key] = [pos[0] + line_offset, pos[1] + line_offset]
+            conflict_section = ''.join(lines[section["start"]:section["end"]])
+            conflicts.append({"start":section["start"]+line_offset, "end":section["end"]+line_offset, "section": conflict_section, "orig_start":section["orig_start"]+line_offset, "orig_end":section["orig_end"]+line_offset, "conflicts":section["conflicts"]})
 
-        if self.merge_overwrapped_conflict_section:
-            conflict_section_pos = self._merge_sections(conflict_section_pos)
+        return conflicts
 
-        for pos in conflict_section_pos:
-            conflict_section = ''.join(lines[pos[0]:pos[1]])
-            conflicts.append({"start":pos[0], "end":pos[1], "section": conflict_section, "orig_start":pos[2], "orig_end":pos[3]})
+    def _get_all_files(self):
+        if GitUtil.is_work_tree(self.path):
+            # honour .gitignore
+            return [os.path.join(self.path, file) for file in GitUtil.get_files(self.path)]
+        result = []
+        for root, dirs, files in os.walk(self.path):
+            if ".git" in dirs:
+                dirs.remove(".git")
+            for file in files:
+                result.append(os.path.join(root, file))
+        return result
 
-        return conflicts
+    def get_target_files(self):
+        if not self.full_scan and GitUtil.is_work_tree(self.path):
+            # the conflicted files are unmerged in the index
+            return [os.path.join(self.path, file) for file in GitUtil.get_unmerged(self.path)]
+        return self._get_all_files()
 
     def get_conflicts(self):
         conflicts = {}
-        for root, _, files in os.walk(self.path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                file_conflicts = self._extract_conflicts(file_path)
-                if file_conflicts:
-                    conflicts[file_path] = file_conflicts
+        # the binary files and the files without the marker are skipped in the scanner
+        scanner = ConflictScanner(self.margin_line_count, self.scan_workers)
+        for file_path, windows, is_utf8 in scanner.scan(file_path for file_path in self.get_target_files() if os.path.isfile(file_path)):
+            if not is_utf8:
+                if not self.include_non_utf8:
+                    print(f'{file_path} is not UTF-8. Skipped.')
+                    continue
+                print(f'{file_path} is not UTF-8. The invalid bytes are replaced.')
+            file_conflicts = []
+            for start_line, lines in windows:
+                file_conflicts.extend(self._extract_conflicts_from_lines(lines, start_line))
+            if file_conflicts:
+                conflicts[file_path] = file_conflicts
         return conflicts
 
 def main():
@@ -130,15 +175,29 @@ def main():
     parser.add_argument('-n', '--numbers', default="", action='store', help='Specify gerrit numbers with ,')
     parser.add_argument('--gitpath', default=None, action='store', help='Specify regexp for project(gitpath) if necessary')
 
-    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http')
+    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http or rest (query via Gerrit REST API)')
+    parser.add_argument('--sshmux', default=False, action='store_true', help='Specify if share one ssh connection (ControlMaster) for gerrit and git access')
 
     parser.add_argument('-d', '--download', default='.', help='Specify download path')
     parser.add_argument('-r', '--renew', default=False, action='store_true', help='Specify if re-download anyway')
+    parser.add_argument('--mirror', default=None, action='store', help='Specify bare mirror directory shared among the downloads')
+    parser.add_argument('--repo', default=None, action='store', help='Specify existing repo workspace (which has .repo) to download the changes with repo download into the project directories')
+    parser.add_argument('--sparse', default=False, action='store_true', help='Specify if check out only the changed files and the commented files with partial clone')
+    parser.add_argument('--depth', default=0, type=int, action='store', help='Specify history depth of partial clone (0: full history)')
+    parser.add_argument('--workers', default=GerritDownloader.DEFAULT_WORKERS, type=int, action='store', help='Specify number of parallel downloads')
+    parser.add_argument('--hostworkers', default=GerritDownloader.DEFAULT_HOST_WORKERS, type=int, action='store', help='Specify max parallel downloads per git host')
+    parser.add_argument('--quota', default=None, action='store', help='Specify disk quota of the download path e.g. 100G. The least recently used workspaces are removed if exceeded')
     parser.add_argument('-m', '--marginline', default=10, type=int, action='store', help='Specify margin lines')
     parser.add_argument('-l', '--largerconflictsection', default=False, action='store_true', help='Specify if unify overwrapped sections')
+    parser.add_argument('--fullscan', default=False, action='store_true', help='Specify if scan all the files (except .gitignore-d and binary) for conflict markers instead of the unmerged files')
     args = parser.parse_args()
 
-    result = GerritUtil.query(args.target, args.branch, args.status, args.since, args.numbers.split(","), [], args.connection, args.gitpath)
+    if args.sshmux:
+        SshUtil.start_multiplexer([args.target])
+
+    result = GerritUtil.query(args.target, args.branch, args.status, args.since, args.numbers.split(","), ["--files", "--current-patch-set"] if args.sparse else [], args.connection, args.gitpath)
+    downloader = GerritDownloader.new_downloader(args)
+    downloader.prefetch(GerritUtil.ungroup_results(result))
     for project, data in result.items():
         for branch, theData in data.items():
             for _data in theData:
@@ -147,8 +206,10 @@ def main():
                 for key, value in _data.items():
                     print(f'{key}:{value}')
                 print("")
-                download_path = GerritUtil.download(args.download, _data["number"], _data["patchset1_ssh"], args.renew)
-                conflict_detector = ConflictExtractor(download_path, args.marginline, args.largerconflictsection)
+                download_path = downloader.get(_data)
+                if not download_path:
+                    continue
+                conflict_detector = ConflictExtractor(download_path, args.marginline, args.largerconflictsection, args.fullscan, include_non_utf8=True)
                 conflict_sections = conflict_detector.get_conflicts()
                 for file_name, sections in conflict_sections.items():
                     print(file_name)
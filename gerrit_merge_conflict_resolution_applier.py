@@ -19,6 +19,8 @@ import re
 import itertools
 
 from GerritUtil import GerritUtil
+from GerritDownloader import GerritDownloader
+from SshUtil import SshUtil
 from GitUtil import GitUtil
 from GptHelper import GptClientFactory
 from gerrit_merge_conflict_extractor import ConflictExtractor
@@ -243,12 +245,21 @@ def main():
     parser.add_argument('-n', '--numbers', default="", action='store', help='Specify gerrit numbers with ,')
     parser.add_argument('--gitpath', default=None, action='store', help='Specify regexp for project(gitpath) if necessary')
 
-    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http')
+    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http or rest (query via Gerrit REST API)')
+    parser.add_argument('--sshmux', default=False, action='store_true', help='Specify if share one ssh connection (ControlMaster) for gerrit and git access')
 
     parser.add_argument('-w', '--download', default='.', help='Specify download path')
     parser.add_argument('-r', '--renew', default=False, action='store_true', help='Specify if re-download anyway')
+    parser.add_argument('--mirror', default=None, action='store', help='Specify bare mirror directory shared among the downloads')
+    parser.add_argument('--repo', default=None, action='store', help='Specify existing repo workspace (which has .repo) to download the changes with repo download into the project directories')
+    parser.add_argument('--sparse', default=False, action='store_true', help='Specify if check out only the changed files and the commented files with partial clone')
+    parser.add_argument('--depth', default=0, type=int, action='store', help='Specify history depth of partial clone (0: full history)')
+    parser.add_argument('--workers', default=GerritDownloader.DEFAULT_WORKERS, type=int, action='store', help='Specify number of parallel downloads')
+    parser.add_argument('--hostworkers', default=GerritDownloader.DEFAULT_HOST_WORKERS, type=int, action='store', help='Specify max parallel downloads per git host')
+    parser.add_argument('--quota', default=None, action='store', help='Specify disk quota of the download path e.g. 100G. The least recently used workspaces are removed if exceeded')
     parser.add_argument('-m', '--marginline', default=10, type=int, action='store', help='Specify margin lines')
     parser.add_argument('-l', '--largerconflictsection', default=False, action='store_true', help='Specify if unify overwrapped sections')
+    parser.add_argument('--fullscan', default=False, action='store_true', help='Specify if scan all the files (except .gitignore-d and binary) for conflict markers instead of the unmerged files')
 
     parser.add_argument('-c', '--useclaude', action='store_true', default=False, help='specify if you want to use calude3')
     parser.add_argument('-g', '--gpt', action='store', default="openai", help='specify openai or calude3 or openaicompatible')
@@ -262,11 +273,16 @@ def main():
 
     args = parser.parse_args()
 
+    if args.sshmux:
+        SshUtil.start_multiplexer([args.target])
+
     gpt_client = GptClientFactory.new_client(args)
     solver = MergeConflictSolver(gpt_client, args.promptfile)
     applier = MergeConflictResolutionApplier(args.marginline)
 
-    result = GerritUtil.query(args.target, args.branch, args.status, args.since, args.numbers.split(","), [], args.connection, args.gitpath)
+    result = GerritUtil.query(args.target, args.branch, args.status, args.since, args.numbers.split(","), ["--files", "--current-patch-set"] if args.sparse else [], args.connection, args.gitpath)
+    downloader = GerritDownloader.new_downloader(args)
+    downloader.prefetch(GerritUtil.ungroup_results(result))
 
     for project, data in result.items():
         for branch, theData in data.items():
@@ -276,8 +292,10 @@ def main():
                 for key, value in _data.items():
                     print(f'{key}:{value}')
                 print("")
-                download_path = GerritUtil.download(args.download, _data["number"], _data["patchset1_ssh"], args.renew)
-                conflict_detector = ConflictExtractor(download_path, args.marginline, args.largerconflictsection)
+                download_path = downloader.get(_data)
+                if not download_path:
+                    continue
+                conflict_detector = ConflictExtractor(download_path, args.marginline, args.largerconflictsection, args.fullscan)
                 conflict_sections = conflict_detector.get_conflicts()
                 for file_name, sections in conflict_sections.items():
                     print(file_name)
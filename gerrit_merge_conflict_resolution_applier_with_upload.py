@@ -19,6 +19,9 @@ import re
 import itertools
 
 from GerritUtil import GerritUtil
+from GerritDownloader import GerritDownloader
+from GerritUploader import GerritUploader
+from SshUtil import SshUtil
 from GitUtil import GitUtil
 from ExecUtil import ExecUtil
 from GptHelper import GptClientFactory, IGpt
@@ -30,6 +33,7 @@ from FileUtil import FileUtil
 
 class UploadableChecker:
     PROMPT_FILE = os.path.join(os.path.dirname(__file__), "git_merge_resolved_checker.json")
+    DIFF_OPTIONS = ["--ignore-space-at-eol", "--ignore-cr-at-eol"]
 
     def __init__(self, client=None, promptfile=None):
         self.system_prompt, self.user_prompt = IGpt.read_prompt_json(UploadableChecker.PROMPT_FILE)
@@ -97,28 +101,9 @@ class UploadableChecker:
     def get_non_diff_result(self, git_dir, file_path, margin_lines = 10):
         results = ["The following is a part of changed code (non-diff):"]
 
-        # extract diff positions
-        diff_result = GitUtil.diff(git_dir, f"--ignore-space-at-eol --ignore-cr-at-eol {file_path}")
-        positions = []
-        for line in diff_result:
-            if line.startswith("@@ "):
-                start_pos = None
-                line_count = None
-                pos = line.find("+")
-                if pos:
-                    line = line[pos+1:]
-                pos = line.find(",")
-                if pos:
-                    start_pos = line[:pos]
-                    line = line[pos+1:]
-                pos = line.find(" @@ ")
-                if pos:
-                    line_count = line[:pos]
-                if start_pos and line_count:
-                    try:
-                        positions.append([int(start_pos), int(line_count)])
-                    except:
-                        pass
+        # extract diff positions. the diff is cached by is_diff_ok()
+        hunks = GitUtil.diff_files(git_dir, [file_path], UploadableChecker.DIFF_OPTIONS).get_hunks(file_path)
+        positions = [[hunk["new_start"], hunk["new_count"]] for hunk in hunks if hunk["new_start"] != None]
 
         target_file_lines = FileUtil.read_file(os.path.join(git_dir, file_path))
         target_file_lines_length = len(target_file_lines)
@@ -157,7 +142,7 @@ class UploadableChecker:
         if is_ok:
             # Not found the conflict marker
             # --- Try to check with git diff
-            diff_result = GitUtil.diff(git_dir, f"--ignore-space-at-eol --ignore-cr-at-eol {file_path}")
+            diff_result = GitUtil.diff_files(git_dir, [file_path], UploadableChecker.DIFF_OPTIONS).get_lines(file_path)
             is_ok = self._check_change(diff_result)
 
             # --- Try to check with non-diff (Fallback for LMM's confusion)
@@ -169,6 +154,92 @@ class UploadableChecker:
         return is_ok
 
 
+def resolve_change(args, solver, applier, checker, downloader, uploader, project, branch, _data):
+    canUpload = True
+    print(f'project:{project}')
+    print(f'branch:{branch}')
+    for key, value in _data.items():
+        print(f'{key}:{value}')
+    print("")
+    download_path = downloader.get(_data)
+    if not download_path:
+        return False
+    conflict_detector = ConflictExtractor(download_path, args.marginline, args.largerconflictsection, args.fullscan)
+    conflict_sections = conflict_detector.get_conflicts()
+    modified_files = []
+    for file_name, sections in conflict_sections.items():
+        is_resolution_ok = False
+        retry_count = 0
+        target_file_lines_orig = FileUtil.read_file(file_name)
+        while(not is_resolution_ok and retry_count<3):
+            retry_count += 1
+            print(f"{file_name} ({retry_count=}))")
+            _target_file_lines = []
+            target_file_lines = target_file_lines_orig.copy()
+            # get resolutions for each conflicted area
+            resolutions = []
+            _resolutions = []
+            resolution_section_mapper={}
+            last_pos = 0
+            for i,section in enumerate(sections):
+                start_pos = section["start"]
+                end_pos = section["end"]
+                orig_start_pos = section["orig_start"]
+                orig_end_pos = section["orig_end"]
+                conflict_section_codes = section["section"]
+                print(f'---conflict_section---{i} ({file_name})')
+                if len(conflict_section_codes)>300:
+                    print(conflict_section_codes[0:300]+"\n..snip..")
+                else:
+                    print(conflict_section_codes)
+                resolution, _full_response = solver.query(conflict_section_codes)
+                print(f'---resolution---{i} ({file_name})')
+                print(resolution)
+                codes = applier.get_code_section(resolution)
+                resolutions.extend( codes )
+                for _code in codes:
+                    _code = str(_code)
+                    resolution_section_mapper[_code] = [start_pos, end_pos, orig_start_pos, orig_end_pos]
+                    if orig_start_pos!=None and orig_start_pos>=start_pos:
+                        resolution_section_mapper[_code].append(target_file_lines[start_pos:orig_start_pos+1])
+                    else:
+                        resolution_section_mapper[_code].append([target_file_lines[start_pos]])
+                    if orig_end_pos!=None and orig_end_pos<=end_pos:
+                        resolution_section_mapper[_code].append(target_file_lines[orig_end_pos:end_pos])
+                    else:
+                        resolution_section_mapper[_code].append([target_file_lines[end_pos]])
+
+            # apply resolutions for the file
+            resolutions_lines = list(itertools.chain(*resolutions))
+            target_file_lines = applier.solve_merge_conflict(target_file_lines, sections, resolutions_lines, resolutions, resolution_section_mapper)
+            if args.apply or args.upload:
+                FileUtil.save_modified_code(file_name, target_file_lines)
+                if not file_name in modified_files:
+                    modified_files.append(file_name)
+                is_resolution_ok = checker.is_diff_ok(download_path, file_name)
+                if is_resolution_ok:
+                    print(f"{file_name}'s git diff should be OK to git commit; git push")
+                    break
+                else:
+                    print(f"{file_name}'s git diff seems to be NOT OK to git commit; git push")
+                    # will retry
+            else:
+                is_resolution_ok = True # this means may include not complete resolution but it should be ok since it's not applied
+                break
+        canUpLoad = canUpload and is_resolution_ok
+
+    is_uploaded = False
+    if args.upload:
+        if not conflict_sections:
+            print("No conflict to upload")
+        elif canUpload:
+            is_uploaded = uploader.add(download_path, branch, _data["number"], modified_files)
+        else:
+            print(f"{canUpload=}")
+
+    return is_uploaded
+
+
 def main():
     parser = argparse.ArgumentParser(description='Extract merge conflict for downloaded gerrit patch')
     parser.add_argument('-t', '--target', default=os.getenv("GERRIT_HOST", 'gerrit-ssh'), help='Specify ssh target host')
@@ -178,12 +249,21 @@ def main():
     parser.add_argument('-n', '--numbers', default="", action='store', help='Specify gerrit numbers with ,')
     parser.add_argument('--gitpath', default=None, action='store', help='Specify regexp for project(gitpath) if necessary')
 
-    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http')
+    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http or rest (query via Gerrit REST API)')
+    parser.add_argument('--sshmux', default=False, action='store_true', help='Specify if share one ssh connection (ControlMaster) for gerrit and git access')
 
     parser.add_argument('-w', '--download', default='.', help='Specify download path')
     parser.add_argument('-r', '--renew', default=False, action='store_true', help='Specify if re-download anyway')
+    parser.add_argument('--mirror', default=None, action='store', help='Specify bare mirror directory shared among the downloads')
+    parser.add_argument('--repo', default=None, action='store', help='Specify existing repo workspace (which has .repo) to download the changes with repo download into the project directories')
+    parser.add_argument('--sparse', default=False, action='store_true', help='Specify if check out only the changed files and the commented files with partial clone')
+    parser.add_argument('--depth', default=0, type=int, action='store', help='Specify history depth of partial clone (0: full history)')
+    parser.add_argument('--workers', default=GerritDownloader.DEFAULT_WORKERS, type=int, action='store', help='Specify number of parallel downloads')
+    parser.add_argument('--hostworkers', default=GerritDownloader.DEFAULT_HOST_WORKERS, type=int, action='store', help='Specify max parallel downloads per git host')
+    parser.add_argument('--quota', default=None, action='store', help='Specify disk quota of the download path e.g. 100G. The least recently used workspaces are removed if exceeded')
     parser.add_argument('-m', '--marginline', default=10, type=int, action='store', help='Specify margin lines')
     parser.add_argument('-l', '--largerconflictsection', default=False, action='store_true', help='Specify if unify overwrapped sections')
+    parser.add_argument('--fullscan', default=False, action='store_true', help='Specify if scan all the files (except .gitignore-d and binary) for conflict markers instead of the unmerged files')
 
     parser.add_argument('-c', '--useclaude', action='store_true', default=False, help='specify if you want to use calude3 (force to use claude3 for option backward compatibiliy)')
     parser.add_argument('-g', '--gpt', action='store', default="openai", help='specify openai or calude3 or openaicompatible')
@@ -197,9 +277,15 @@ def main():
 
     parser.add_argument('-a', '--apply', action='store_true', default=False, help='Specify if apply the modification for the conflicted file')
     parser.add_argument('-u', '--upload', action='store_true', default=False, help='Specify if upload the the conflict resolved result')
+    parser.add_argument('--label', action='append', default=[], help='Specify label to vote on the uploaded patchset e.g. Code-Review=+1 (multiple --label are ok)')
+    parser.add_argument('--message', action='store', default=None, help='Specify review message to post on the uploaded patchset')
+    parser.add_argument('--uploadbatch', default=GerritUploader.DEFAULT_BATCH_SIZE, type=int, action='store', help='Specify number of amended changes to keep before pushing them one by one and posting --label/--message in one gerrit review (1: push each change immediately)')
 
     args = parser.parse_args()
 
+    if args.sshmux:
+        SshUtil.start_multiplexer([args.target])
+
     gpt_client = GptClientFactory.new_client(args)
     solver = MergeConflictSolver(gpt_client, args.promptfile)
     applier = MergeConflictResolutionApplier(args.marginline)
@@ -207,83 +293,13 @@ def main():
     #print(f"UploadableChecker:{args.useclaude=}")
     checker = UploadableChecker( GptClientFactory.new_client(args) ) #gpt_client)
 
-    result = GerritUtil.query(args.target, args.branch, args.status, args.since, args.numbers.split(","), [], args.connection, args.gitpath)
-    for project, data in result.items():
-        for branch, theData in data.items():
-            for _data in theData:
-                canUpload = True
-                print(f'project:{project}')
-                print(f'branch:{branch}')
-                for key, value in _data.items():
-                    print(f'{key}:{value}')
-                print("")
-                download_path = GerritUtil.download(args.download, _data["number"], _data["patchset1_ssh"], args.renew)
-                conflict_detector = ConflictExtractor(download_path, args.marginline, args.largerconflictsection)
-                conflict_sections = conflict_detector.get_conflicts()
-                for file_name, sections in conflict_sections.items():
-                    is_resolution_ok = False
-                    retry_count = 0
-                    target_file_lines_orig = FileUtil.read_file(file_name)
-                    while(not is_resolution_ok and retry_count<3):
-                        retry_count += 1
-                        print(f"{file_name} ({retry_count=}))")
-                        _target_file_lines = []
-                        target_file_lines = target_file_lines_orig.copy()
-                        # get resolutions for each conflicted area
-                        resolutions = []
-                        _resolutions = []
-                        resolution_section_mapper={}
-                        last_pos = 0
-                        for i,section in enumerate(sections):
-                            start_pos = section["start"]
-                            end_pos = section["end"]
-                            orig_start_pos = section["orig_start"]
-                            orig_end_pos = section["orig_end"]
-                            conflict_section_codes = section["section"]
-                            print(f'---conflict_section---{i} ({file_name})')
-                            if len(conflict_section_codes)>300:
-                                print(conflict_section_codes[0:300]+"\n..snip..")
-                            else:
-                                print(conflict_section_codes)
-                            resolution, _full_response = solver.query(conflict_section_codes)
-                            print(f'---resolution---{i} ({file_name})')
-                            print(resolution)
-                            codes = applier.get_code_section(resolution)
-                            resolutions.extend( codes )
-                            for _code in codes:
-                                _code = str(_code)
-                                resolution_section_mapper[_code] = [start_pos, end_pos, orig_start_pos, orig_end_pos]
-                                if orig_start_pos!=None and orig_start_pos>=start_pos:
-                                    resolution_section_mapper[_code].append(target_file_lines[start_pos:orig_start_pos+1])
-                                else:
-                                    resolution_section_mapper[_code].append([target_file_lines[start_pos]])
-                                if orig_end_pos!=None and orig_end_pos<=end_pos:
-                                    resolution_section_mapper[_code].append(target_file_lines[orig_end_pos:end_pos])
-                                else:
-                                    resolution_section_mapper[_code].append([target_file_lines[end_pos]])
-
-                        # apply resolutions for the file
-                        resolutions_lines = list(itertools.chain(*resolutions))
-                        target_file_lines = applier.solve_merge_conflict(target_file_lines, sections, resolutions_lines, resolutions, resolution_section_mapper)
-                        if args.apply or args.upload:
-                            FileUtil.save_modified_code(file_name, target_file_lines)
-                            is_resolution_ok = checker.is_diff_ok(download_path, file_name)
-                            if is_resolution_ok:
-                                print(f"{file_name}'s git diff should be OK to git commit; git push")
-                                break
-                            else:
-                                print(f"{file_name}'s git diff seems to be NOT OK to git commit; git push")
-                                # will retry
-                        else:
-                            is_resolution_ok = True # this means may include not complete resolution but it should be ok since it's not applied
-                            break
-                    canUpLoad = canUpload and is_resolution_ok
-
-                if args.upload:
-                    if canUpload:
-                        GerritUtil.upload(download_path, branch)
-                    else:
-                        print(f"{canUpload=}")
+    results = GerritUtil.iter_query(args.target, args.branch, args.status, args.since, args.numbers.split(","), ["--files", "--current-patch-set"] if args.sparse else [], args.connection, args.gitpath)
+    downloader = GerritDownloader.new_downloader(args)
+    uploader = GerritUploader.new_uploader(args, downloader)
+    # start the first change while gerrit is still returning the results
+    for project, branch, _data in downloader.iter_prefetch(results):
+        resolve_change(args, solver, applier, checker, downloader, uploader, project, branch, _data)
+    uploader.flush()
 
 
 if __name__ == "__main__":
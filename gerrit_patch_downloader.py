@@ -15,6 +15,8 @@
 import os
 import argparse
 from GerritUtil import GerritUtil
+from GerritDownloader import GerritDownloader
+from SshUtil import SshUtil
 from GitUtil import GitUtil
 
 def main():
@@ -24,20 +26,31 @@ def main():
     parser.add_argument('-s', '--status', default='merged|open', help='Status to query (merged|open)')
     parser.add_argument('--since', default='1 week ago', help='Since when to query')
     parser.add_argument('-n', '--numbers', default="", action='store', help='Specify gerrit numbers with ,')
+    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http or rest (query via Gerrit REST API)')
+    parser.add_argument('--sshmux', default=False, action='store_true', help='Specify if share one ssh connection (ControlMaster) for gerrit and git access')
     parser.add_argument('-d', '--download', default='.', help='Specify download path')
     parser.add_argument('-r', '--renew', default=False, action='store_true', help='Specify if re-download anyway')
+    parser.add_argument('--mirror', default=None, action='store', help='Specify bare mirror directory shared among the downloads')
+    parser.add_argument('--repo', default=None, action='store', help='Specify existing repo workspace (which has .repo) to download the changes with repo download into the project directories')
+    parser.add_argument('--sparse', default=False, action='store_true', help='Specify if check out only the changed files and the commented files with partial clone')
+    parser.add_argument('--depth', default=0, type=int, action='store', help='Specify history depth of partial clone (0: full history)')
+    parser.add_argument('--workers', default=GerritDownloader.DEFAULT_WORKERS, type=int, action='store', help='Specify number of parallel downloads')
+    parser.add_argument('--hostworkers', default=GerritDownloader.DEFAULT_HOST_WORKERS, type=int, action='store', help='Specify max parallel downloads per git host')
+    parser.add_argument('--quota', default=None, action='store', help='Specify disk quota of the download path e.g. 100G. The least recently used workspaces are removed if exceeded')
     args = parser.parse_args()
 
-    result = GerritUtil.query(args.target, args.branch, args.status, args.since, args.numbers.split(","))
-    for project, data in result.items():
-        for branch, theData in data.items():
-            for _data in theData:
-                print(f'project:{project}')
-                print(f'branch:{branch}')
-                for key, value in _data.items():
-                    print(f'{key}:{value}')
-                print("")
-                GerritUtil.download(args.download, _data["number"], _data["patchset1_ssh"], args.renew)
+    if args.sshmux:
+        SshUtil.start_multiplexer([args.target])
+
+    results = GerritUtil.iter_query(args.target, args.branch, args.status, args.since, args.numbers.split(","), ["--files", "--current-patch-set"] if args.sparse else [], args.connection)
+    with GerritDownloader.new_downloader(args) as downloader:
+        for project, branch, _data, download_path in downloader.download_all(results):
+            print(f'project:{project}')
+            print(f'branch:{branch}')
+            for key, value in _data.items():
+                print(f'{key}:{value}')
+            print(f'download_path:{download_path}')
+            print("")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
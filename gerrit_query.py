@@ -15,6 +15,9 @@
 import os
 import argparse
 from GerritUtil import GerritUtil
+from SshUtil import SshUtil
+from GerritCache import GerritCache
+from ExportUtil import ExportUtil
 
 def main():
     parser = argparse.ArgumentParser(description='Query Gerrit and parse results')
@@ -23,18 +26,44 @@ def main():
     parser.add_argument('-s', '--status', default='merged|open', help='Status to query (merged|open)')
     parser.add_argument('--since', default='1 week ago', help='Since when to query')
     parser.add_argument('-n', '--numbers', default="", action='store', help='Specify gerrit numbers with ,')
+    parser.add_argument('--connection', default="http", action='store', help='Specify ssh or http or rest (query via Gerrit REST API)')
+    parser.add_argument('--sshmux', default=False, action='store_true', help='Specify if share one ssh connection (ControlMaster) for gerrit and git access')
     parser.add_argument('-g', '--gitpath', default=None, action='store', help='Specify regexp for project(gitpath) if necessary')
+    parser.add_argument('--maxrows', default=None, type=int, action='store', help='Specify max number of changes to query over the pages')
+    parser.add_argument('--cache', default=None, action='store', help='Specify sqlite cache file to sync changes incrementally')
+    parser.add_argument('--offline', default=False, action='store_true', help='Specify if answer from the --cache without querying gerrit')
+    parser.add_argument('-o', '--output', default='text', choices=ExportUtil.OUTPUT_FORMATS, help='Specify output format (text|jsonl|parquet|arrow)')
+    parser.add_argument('--outfile', default='-', action='store', help='Specify output file for jsonl|parquet|arrow (- is stdout for jsonl. required for parquet|arrow)')
     args = parser.parse_args()
+    if args.output in ExportUtil.COLUMNAR_FORMATS and args.outfile == "-":
+        parser.error(f'--outfile is required for --output {args.output}')
+
+    if args.sshmux:
+        SshUtil.start_multiplexer([args.target])
+
+    if args.cache:
+        cache = GerritCache(args.cache)
+        if not args.offline:
+            cache.sync(args.target, args.branch, args.since, args.numbers.split(","), [], args.connection)
+        results = cache.iter_query(args.branch, args.status, args.since, args.numbers.split(","), [], args.connection, args.gitpath)
+    else:
+        results = GerritUtil.iter_query(args.target, args.branch, args.status, args.since, args.numbers.split(","), [], args.connection, args.gitpath, args.maxrows)
+
+    if args.output == "text":
+        for project, data in GerritUtil.group_results(results).items():
+            for branch, theData in data.items():
+                for _data in theData:
+                    print(f'project:{project}')
+                    print(f'branch:{branch}')
+                    for key, value in _data.items():
+                        print(f'{key}:{value}')
+                    print("")
+    else:
+        # stream the records to the file as they are parsed
+        with ExportUtil.new_writer(args.output, args.outfile, ExportUtil.CHANGE_SCHEMA) as writer:
+            for project, branch, _data in results:
+                writer.write(ExportUtil.change_to_row(project, branch, _data))
 
-    result = GerritUtil.query(args.target, args.branch, args.status, args.since, args.numbers.split(","), [], "http", args.gitpath)
-    for project, data in result.items():
-        for branch, theData in data.items():
-            for _data in theData:
-                print(f'project:{project}')
-                print(f'branch:{branch}')
-                for key, value in _data.items():
-                    print(f'{key}:{value}')
-                print("")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
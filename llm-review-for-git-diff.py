@@ -33,6 +33,8 @@ if __name__=="__main__":
     checker = UploadableChecker(gpt_client)
 
     all_modified, result_to_be_commited, result_changes_not_staged, result_untracked = GitUtil.status(".")
+    # one git diff for all the files. is_diff_ok() uses the cached result.
+    GitUtil.diff_files(".", all_modified, UploadableChecker.DIFF_OPTIONS)
 
     for file_path in all_modified:
         result = checker.is_diff_ok(".", file_path)